@@ -4,17 +4,42 @@
 
 import sys
 import re
+import os
 import os.path
 import code
+import shutil
+import tempfile
+import multiprocessing
+
+from ast import literal_eval
+from StringIO import StringIO
+from contextlib import contextmanager
 
 import cuac.tools
 from cuac.libs.iotools import ShelfLoader, ContextMaker, Interactor
+from cuac.libs.templite import code_names, ProfiledAccumulator, LineProfiler
+from cuac.libs.tracer import Tracer
+from cuac.tools.dot import DotFilter
 
 
 # Nombre de variable valido. Excluyo los que comienzan por "_",
 # estan reservados para atributos internos del plantillator.
 varpattern = re.compile(r'^[a-zA-Z][a-zA-Z0-9_]*$')
 
+# Consumer que usan los procesos hijos (ver Consumer._fork). Los procesos
+# lo heredan al hacer fork, con los datos ya cargados.
+_WORKER = None
+
+
+def _batch(job):
+    """Ejecuta un trabajo de Consumer.batch. Se ejecuta en un proceso aparte."""
+    return (job[0],) + _WORKER.run(*job)
+
+
+def _exhaust(roots):
+    """Ejecuta una parte de Consumer.exhaust. Se ejecuta en un proceso aparte."""
+    return _WORKER.exhaust_roots(roots)
+
 
 class Consumer(object):
 
@@ -27,11 +52,18 @@ class Consumer(object):
         'overwrite': True,
         'collapse': False,
         'definitions': [],
+        'literals': False,
         'inputfiles': [],
         'ext': ".cfg",
         'test': False,
         'lazy': False,
         'warnings': False,
+        'onchange': False,
+        'incremental': False,
+        'trace': None,
+        'memos': False,
+        'profile': None,
+        'lineprof': None,
     }
 
     def __init__(self):
@@ -50,39 +82,295 @@ class Consumer(object):
             template  = None
         self.tmplname = template
         self.loader = ShelfLoader(datashelf)
+        self.loader.keep_memos = self.memos
         self.warnings = dict() if self.warnings else None
+        # Solo se pueden conservar salidas que vayan a ficheros propios.
+        self.incremental = bool(self.incremental and self.outpath and not self.collapse)
+        self._skipped = 0
+        self.tracer = Tracer() if self.trace else None
+        self.profiler = LineProfiler() if self.lineprof else None
         try:
             self.loader.set_datapath(self.path, warnings=self.warnings, lazy=self.lazy)
             self.loader.set_tmplpath(self.path)
-            self.maker = ContextMaker(self.outpath, self.ext, self.collapse, self.overwrite)
-            self.actor = Interactor()
-            self._add_objects()
-            self.loader.add_symbols({
-                "OUTDIR": self.maker.output_dir,
-                "INSERT": self.INSERT,
-                "APPEND": self.APPEND,
-                "SAVEAS": self.SAVEAS,
-                "SELECT": self.SELECT,
-                "BREAK":  self.BREAK,
-                "tools":  tools,
-                })
+            self._setup()
         except:
             self.loader.close()
             raise
 
+    def _setup(self):
+        """Prepara la salida y los simbolos globales de una ejecucion"""
+        # Copia de los datos sin definiciones, ver "reload".
+        self._base = dict(self.loader.data)
+        self.maker = ContextMaker(self.outpath, self.ext, self.collapse, self.overwrite, self.onchange)
+        self.actor = Interactor()
+        self._add_objects()
+        self.loader.add_symbols({
+            "OUTDIR": self.maker.output_dir,
+            "INSERT": self.INSERT,
+            "APPEND": self.APPEND,
+            "SAVEAS": self.SAVEAS,
+            "OPEN":   self.OPEN,
+            "SELECT": self.SELECT,
+            "BREAK":  self.BREAK,
+            "tools":  cuac.tools,
+            })
+
+    def reload(self):
+        """Prepara una nueva ejecucion, en un proceso de larga duracion.
+
+        Vuelve a comprobar las plantillas, recarga los datos si ha cambiado
+        algun CSV, y evalua de nuevo las definiciones (que pueden haber
+        cambiado desde la ultima ejecucion). Las plantillas y los datos que
+        no han cambiado se reutilizan sin volver a leerlos.
+
+        Ojo: si una plantilla modifica los objetos de datos, los cambios
+        se mantienen hasta que se recarguen los CSV.
+        """
+        self.loader.refresh()
+        if self.loader.changed(self.path):
+            self.loader.set_datapath(self.path, warnings=self.warnings, lazy=self.lazy)
+        else:
+            self.loader.data.clear()
+            self.loader.data.update(self._base)
+        self._skipped = 0
+        self._setup()
+
+    def run(self, tmplname, definitions=None, outpath=None, literals=False):
+        """Ejecuta una plantilla, en un proceso de larga duracion.
+
+        Recarga lo que haya cambiado (ver "reload"), ejecuta la plantilla
+        con las definiciones dadas y captura lo que se escribe en stdout
+        (la salida, si no hay directorio de salida, y los resumenes).
+        Si no se da outpath, se mantiene el de la ejecucion anterior.
+        Si literals=True, las definiciones solo admiten valores literales
+        (ver _add_objects).
+
+        Devuelve una tupla (texto, error), donde error es None si todo
+        ha ido bien, o el texto del error.
+        """
+        output = StringIO()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            self.tmplname = tmplname
+            self.definitions = definitions or []
+            self.literals = literals
+            if outpath is not None:
+                self.outpath = outpath
+            self.reload()
+            self.render()
+            self.dump_summary()
+            return (output.getvalue(), None)
+        except Exception as details:
+            return (output.getvalue(), str(details) or details.__class__.__name__)
+        finally:
+            sys.stdout = stdout
+
+    def batch(self, jobs, processes=None):
+        """Ejecuta varias plantillas con los mismos datos.
+
+        "jobs" es una lista de tuplas (plantilla, definiciones, outpath),
+        los argumentos de "run". Si processes no es 1 y el sistema tiene
+        fork, los trabajos se reparten entre varios procesos, que heredan
+        los datos ya cargados. En ese caso, los procesos no guardan nada
+        en el shelf (ni plantillas compiladas, ni registros de -i).
+
+        Devuelve una lista con una tupla (plantilla, texto, error) por
+        trabajo, en el mismo orden.
+        """
+        if processes == 1 or len(jobs) < 2 or not hasattr(os, "fork"):
+            return [(job[0],) + self.run(*job) for job in jobs]
+        # Compilo antes las plantillas principales, para no hacerlo en
+        # cada proceso. Los errores los informara cada trabajo.
+        for job in jobs:
+            try:
+                self.loader.get_template(job[0])
+            except Exception:
+                pass
+        return self._fork(_batch, jobs, processes)
+
+    def exhaust(self, processes=1):
+        """Ejecuta la plantilla con todas las combinaciones de SELECT.
+
+        Es el modo de test. Si processes es 1 (o el sistema no tiene
+        fork), las combinaciones se prueban una tras otra. Si no, la
+        primera ejecucion se hace en este proceso, y las opciones del
+        primer SELECT que queden por probar se reparten entre varios
+        procesos.
+
+        En los dos casos, un error no detiene la prueba: se anota con
+        las elecciones que llevaron a el, y se sigue con la siguiente
+        combinacion que no empiece por esas mismas elecciones (ver
+        _attempt).
+
+        El modo de test es de validacion: solo se conserva la salida
+        (ficheros o stdout) de la primera combinacion. El resto, en los
+        dos casos, se escribe en directorios temporales que luego se
+        borran (ver _scratch).
+
+        Devuelve una tupla (ejecuciones, errores), donde errores es una
+        lista de tuplas (elecciones, texto del error), ordenada por la
+        primera eleccion.
+        """
+        passes, errors = 1, list()
+        if self._attempt(errors):
+            return (passes, errors)
+        if processes == 1 or not hasattr(os, "fork"):
+            with self._scratch():
+                while True:
+                    passes += 1
+                    if self._attempt(errors):
+                        return (passes, sorted(errors))
+        roots = sorted(k for (k, v) in self.actor.tree.iteritems() if not v.exhausted)
+        processes = min(processes or multiprocessing.cpu_count(), len(roots))
+        parts = [roots[i::processes] for i in xrange(processes)]
+        for count, error in self._fork(_exhaust, parts, processes):
+            passes += count
+            errors.extend(error)
+        return (passes, sorted(errors))
+
+    def _attempt(self, errors):
+        """Prueba la siguiente combinacion de SELECT.
+
+        Si falla, anota en "errors" las elecciones hechas hasta el fallo
+        y el texto del error. Esas elecciones se dan por agotadas, asi que
+        las combinaciones que empiezan por ellas no se vuelven a probar.
+
+        Devuelve True si ya no quedan combinaciones por probar.
+        """
+        try:
+            self.render()
+        except Exception as details:
+            choices = tuple(self.actor.path)
+            errors.append((choices, str(details) or details.__class__.__name__))
+        return self.actor.exhausted
+
+    def exhaust_roots(self, roots):
+        """Prueba las combinaciones que empiezan por alguna de las dadas.
+
+        Se ejecuta en un proceso hijo, ver "exhaust". Devuelve una tupla
+        (ejecuciones, errores).
+        """
+        with self._scratch():
+            for name, node in self.actor.tree.iteritems():
+                if name not in roots:
+                    node.exhausted = True
+            passes, errors = 1, list()
+            while not self._attempt(errors):
+                passes += 1
+            return (passes, errors)
+
+    @contextmanager
+    def _scratch(self):
+        """Dirige la salida a un directorio temporal, que luego se borra.
+
+        Lo usa el modo de test para las combinaciones que siguen a la
+        primera. Se conservan las elecciones ya hechas.
+        """
+        outdir, actor = tempfile.mkdtemp(), self.actor
+        outpath, maker = self.outpath, self.maker
+        try:
+            if self.collapse and self.outpath:
+                self.outpath = os.path.join(outdir, os.path.basename(self.outpath))
+            else:
+                self.outpath = outdir
+            self._setup()
+            self.actor = actor
+            yield
+        finally:
+            # El resumen (ver dump_summary) es el de la primera combinacion.
+            self.outpath, self.maker = outpath, maker
+            shutil.rmtree(outdir, ignore_errors=True)
+
+    def _fork(self, func, items, processes=None):
+        """Reparte "items" entre varios procesos, que ejecutan "func".
+
+        Los procesos heredan este Consumer (ver _WORKER), y no guardan
+        nada en el shelf: lo que haya pendiente se guarda antes.
+        """
+        global _WORKER
+        self.loader.close()
+        _WORKER, self.loader.readonly = self, True
+        pool = multiprocessing.Pool(processes)
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+            _WORKER, self.loader.readonly = None, False
+
+    def watched(self):
+        """Devuelve los ficheros de los que depende la ultima ejecucion.
+
+        Es un diccionario { ruta: mtime } con los directorios del path,
+        los ficheros CSV y las plantillas que se han intentado cargar
+        (aunque tuvieran errores). Si cambia, hay que volver a ejecutar
+        (ver "reload").
+        """
+        files = self.loader.scan(self.path)
+        for dirname in self.path:
+            if os.path.isdir(dirname):
+                files[os.path.abspath(dirname)] = os.stat(dirname).st_mtime
+        for source in self.loader.mtimes:
+            if os.path.isfile(source):
+                files[source] = os.stat(source).st_mtime
+        return files
+
+    def precompile(self, dirnames, patterns=None, processes=None):
+        """Compila las plantillas de los directorios y las guarda en el shelf.
+
+        No carga los datos. Si se indica, inputfiles[0] es el shelf.
+        Devuelve lo mismo que ShelfLoader.precompile.
+        """
+        datashelf = self.inputfiles[0] if self.inputfiles else "data.shelf"
+        loader = ShelfLoader(datashelf)
+        try:
+            loader.set_tmplpath(self.path)
+            return loader.precompile(dirnames, patterns or ("*.txt",), processes)
+        finally:
+            loader.close()
+
     def dump_warnings(self):
         self.loader.dump_warnings(self.warnings)
 
+    def dump_summary(self):
+        self.maker.dump_summary()
+        if self.incremental:
+            print "Salidas sin cambios (no regeneradas): %d" % self._skipped
+
+    def dump_trace(self):
+        """Vuelca en el fichero "trace" los datos usados por cada salida"""
+        if self.tracer:
+            self.tracer.dump(self.trace)
+
+    def dump_lineprof(self):
+        """Vuelca en el fichero "lineprof" el perfil de lineas"""
+        if self.profiler:
+            self.profiler.dump(self.lineprof)
+
     def _add_objects(self):
-        """Carga objetos predefinidos e indicados en la linea de comandos."""
+        """Carga objetos predefinidos e indicados en la linea de comandos.
+
+        Si self.literals es True, el valor de cada definicion debe ser un
+        literal de python, y no se evalua (por ejemplo, si las definiciones
+        llegan por la red, ver RenderServer).
+        """
         varpattern = re.compile(r"^[a-zA-Z][a-zA-Z0-9]*$")
         symbols = dict()
+        self._definitions = dict()
         for definition in self.definitions or tuple():
             var, expr = tuple(x.strip() for x in definition.split("=", 1))
             if not varpattern.match(var):
                 raise SyntaxError, "\"%s\" NO es un nombre valido" % var
-            symbols[var] = eval(expr, self.loader.data)
+            if self.literals:
+                try:
+                    symbols[var] = literal_eval(expr)
+                except (ValueError, SyntaxError):
+                    raise SyntaxError, "\"%s\" NO es un valor literal" % expr
+            else:
+                symbols[var] = eval(expr, self.loader.data)
+            self._definitions[var] = expr
         self.loader.add_symbols(symbols)
+        self._tracked = frozenset(self.loader.sources).union(self._definitions)
 
     def _consume(self, tmplid, outname=None):
         if outname is None:
@@ -100,57 +388,203 @@ class Consumer(object):
 
     class Pending(object):
 
-        def __init__(self, tmplid, template, outname, data):
+        def __init__(self, tmplid, template, outname, data, depends=None):
             self.tmplid = tmplid
             self.template = template
             self.outname = outname
             self.data = dict(data)
+            # Dependencias de la salida, { clave: huella }. Incluyen las
+            # de la plantilla que hizo el APPEND, de la que se heredan los
+            # datos (ver Consumer._fingerprint).
+            self.depends = dict(depends or tuple())
+            self.children = list()
+            self.outputs = list()
+            self.interactive = False
 
         def key(self):
             return (self.tmplid, self.outname)
 
-        def render(self, consumer):
+        def render(self, consumer, accumulator=None, profiler=None):
             self.consumer = consumer
-            self.template.render(consumer, self.data)
+            self.template.render(consumer, self.data, accumulator, profiler)
 
         def dup(self, tmplid, template, outname):
-            return Consumer.Pending(tmplid, template, outname, self.data)
+            pending = Consumer.Pending(tmplid, template, outname, self.data, self.depends)
+            pending.interactive = self.interactive
+            self.children.append(pending.key())
+            return pending
 
-        def embed(self, template):
-            template.embed(self.consumer, self.data)
+        def embed(self, template, profiler=None):
+            template.embed(self.consumer, self.data, profiler)
 
     def render(self):
+        self._prints, records = dict(), dict()
+        if self.tracer:
+            self.tracer.install()
         try:
             tmplid, template = self.loader.get_template(self.tmplname)
             pending = Consumer.Pending(tmplid, template, None, self.loader.data)
+            self._depend(pending, self.tmplname, None, template)
             self._queue, self._done = [pending], set()
             while self._queue:
                 self._pending = self._queue.pop(0)
                 key = self._pending.key()
                 if key not in self._done:
                     self._done.add(key)
-                    self._pending.render(self._consume(*key))
+                    if self.incremental and self._skip(key):
+                        continue
+                    if self.tracer:
+                        self.tracer.start(self.maker.get_outname(*key) or key[0])
+                    if not self.profile:
+                        self._pending.render(self._consume(*key), None, self.profiler)
+                    else:
+                        self._pending.render(self._consume(*key), ProfiledAccumulator, self.profiler)
+                        self._dump_profile(key)
+                    if self.incremental:
+                        records[key] = self._record(self._pending)
+        except:
+            # Si la plantilla falla, no reemplazo los ficheros existentes
+            # con una salida a medias.
+            self.maker.close(commit=False)
+            raise
+        else:
+            self.maker.close()
+            if records:
+                self.loader.renders.update(records)
+                self.loader.dirty = True
         finally:
+            # Los diagramas de Graphviz se generan en segundo plano, hay
+            # que esperar a que terminen antes de dar la salida por buena.
+            # Los errores se muestran aunque la plantilla haya fallado.
+            for failure in DotFilter.wait():
+                print >> sys.stderr, failure
+            if self.tracer:
+                self.tracer.uninstall()
             self.loader.close()
 
+    def _dump_profile(self, key):
+        """Vuelca el perfil de la salida al directorio "profile" """
+        if not os.path.isdir(self.profile):
+            os.makedirs(self.profile)
+        outname = os.path.basename(self.maker.get_outname(*key) or key[0])
+        self._pending.data["_out"].dump(os.path.join(self.profile, outname))
+
+    def _fingerprint(self, dep):
+        """Calcula la huella actual de una dependencia.
+
+        Las dependencias son tuplas:
+
+        - ("tmpl", nombre, pista): plantilla cargada con get_template. La
+            huella es la ruta a la que se resuelve y su mtime.
+        - ("name", nombre): dato global, de los CSV o definido con -D. La
+            huella son los ficheros CSV de los que procede y sus mtimes
+            (mas la expresion, si es una definicion).
+        - ("layout",): lista de tablas de primer nivel. Si aparece una tabla
+            nueva, puede ocultar un nombre que antes era local.
+        """
+        try:
+            return self._prints[dep]
+        except KeyError:
+            pass
+        kind, fprint = dep[0], None
+        if kind == "tmpl":
+            try:
+                fprint = self.loader.locate(dep[1], dep[2])
+            except ValueError:
+                pass
+        elif kind == "name":
+            name = dep[1]
+            expr = self._definitions.get(name, None)
+            if expr is None:
+                fprint = self.loader.fingerprint(name)
+            else:
+                names = sorted(code_names(compile(expr, name, "eval")))
+                fprint = (expr, tuple(self.loader.fingerprint(x) for x in names))
+        else:
+            fprint = tuple(sorted(self.loader.sources))
+        return self._prints.setdefault(dep, fprint)
+
+    def _depend(self, pending, tmplname, hint, template=None):
+        """Anota que la salida depende de la plantilla y de sus datos.
+
+        Los datos que usa la plantilla se deducen de los nombres que
+        aparecen en su codigo compilado.
+        """
+        if not self.incremental:
+            return
+        dep = ("tmpl", tmplname, hint)
+        pending.depends[dep] = self._fingerprint(dep)
+        if template is not None:
+            for name in template.names.intersection(self._tracked):
+                dep = ("name", name)
+                pending.depends[dep] = self._fingerprint(dep)
+
+    def _record(self, pending):
+        """Genera el registro de dependencias que se guarda en el shelf"""
+        layout = ("layout",)
+        pending.depends[layout] = self._fingerprint(layout)
+        outputs = list(pending.outputs)
+        outputs.append(self.maker.get_outname(*pending.key()))
+        return (pending.depends, tuple(pending.children), tuple(outputs), pending.interactive)
+
+    def _skip(self, key):
+        """Comprueba si se puede conservar la salida de la ejecucion anterior.
+
+        Solo se puede si no ha cambiado ninguna dependencia, ni de la
+        plantilla ni de las que se ejecutaron con APPEND desde ella (que no
+        se pueden ejecutar por separado, porque heredan sus datos).
+        """
+        visited = set()
+        if not self._unchanged(key, visited):
+            return False
+        self._done.update(visited)
+        self._skipped += len(visited)
+        return True
+
+    def _unchanged(self, key, visited):
+        if key in visited:
+            return True
+        visited.add(key)
+        record = self.loader.renders.get(key, None)
+        if record is None:
+            return False
+        depends, children, outputs, interactive = record
+        # Las salidas que dependen de un SELECT siempre se regeneran.
+        if interactive:
+            return False
+        if self.maker.get_outname(*key) not in outputs:
+            return False
+        if not all(os.path.isfile(x) for x in outputs):
+            return False
+        if any(self._fingerprint(d) != f for (d, f) in depends.iteritems()):
+            return False
+        return all(self._unchanged(child, visited) for child in children)
+
     def INSERT(self, fname, optional=False):
         """Inserta una plantilla en linea"""
         # Damos preferencia en el path al directorio de la plantilla actual
         try:
             tmplid, template = self.loader.get_template(fname, self._pending.tmplid)
-            self._pending.embed(template)
         except ValueError:
+            self._depend(self._pending, fname, self._pending.tmplid)
             if not optional:
                 raise
+        else:
+            self._depend(self._pending, fname, self._pending.tmplid, template)
+            self._pending.embed(template, self.profiler)
         
     def APPEND(self, fname, outname=None, optional=False):
         """Ejecuta una plantilla a posteriori"""
         try:
             tmplid, template = self.loader.get_template(fname, self._pending.tmplid)
-            self._queue.append(self._pending.dup(tmplid, template, outname))
         except ValueError:
+            self._depend(self._pending, fname, self._pending.tmplid)
             if not optional:
                 raise
+        else:
+            pending = self._pending.dup(tmplid, template, outname)
+            self._depend(pending, fname, self._pending.tmplid, template)
+            self._queue.append(pending)
 
     def SELECT(self, sort=True, **kw):
         """Pide al usuario que seleccione elementos.
@@ -169,6 +603,7 @@ class Consumer(object):
             else:
                 item = self.actor.exhaust(items)
             self._pending.data[key] = item
+            self._pending.interactive = True
 
     def SAVEAS(self, outname):
         """Filtro que guarda el contenido del bloque en un fichero.
@@ -177,11 +612,45 @@ class Consumer(object):
         """
         def saveme(strings):
             outpath = self.maker.resolve_relative(outname)
-            with self.maker.get_context(outpath)() as outfile:
+            # Graphviz puede estar leyendo todavia la version anterior.
+            DotFilter.JOBS.release(outpath)
+            # Vuelco el fichero al salir, porque lo normal es que el
+            # siguiente filtro (DOT, NEATO...) lo lea de disco.
+            with self.maker.get_context(outpath, flush=True)() as outfile:
                 outfile.write("".join(strings))
+            self._pending.outputs.append(outpath)
             return (outpath,)
         return saveme
 
+    def OPEN(self, outname):
+        """Abre un fichero de salida, para escribir en el directamente.
+
+        El nombre es relativo a OUTDIR, como en SAVEAS. Devuelve un
+        contexto (para usar con "with") que da el fichero abierto, y cuyo
+        atributo "path" es la ruta completa. Al salir del contexto, el
+        fichero se vuelca a disco, para que lo pueda leer otro proceso.
+        """
+        return Consumer.Output(self, outname)
+
+    class Output(object):
+
+        """Fichero de salida abierto desde una plantilla (ver OPEN)"""
+
+        def __init__(self, consumer, outname):
+            self.path = consumer.maker.resolve_relative(outname)
+            DotFilter.JOBS.release(self.path)
+            self._context = consumer.maker.get_context(self.path, flush=True)()
+            consumer._pending.outputs.append(self.path)
+
+        def __enter__(self):
+            return self._context.__enter__()
+
+        def __exit__(self, *exc_info):
+            return self._context.__exit__(*exc_info)
+
+        def __str__(self):
+            return self.path
+
     def BREAK(self, label=None):
         """Lanza un interprete interactivo, para depuracion"""
         banner = "\n".join((
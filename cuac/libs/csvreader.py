@@ -810,12 +810,15 @@ class CSVShelf(object):
     VARTABLE = "variables"
     FILES    = "data_files"
     DATA     = "data_root"
+    SOURCES  = "data_sources"
     VERSION  = "data_version"
-    CURRENT  = 2
+    CURRENT  = 3
 
     def __init__(self, shelf):
         self.shelf = shelf
         self.dirty = False
+        self.csvfiles = dict()
+        self.sources = dict()
 
     def set_datapath(self, datapath, warnings=None, lazy=False):
         """Busca todos los ficheros CSV en el path.
@@ -838,7 +841,8 @@ class CSVShelf(object):
         completos, asi que si [warnings is not None], el valor de lazy se
         ignora.
         """
-        files = dict(chain(*(self._findcsv(dirname) for dirname in datapath)))
+        files = self.scan(datapath)
+        self.csvfiles = files
         self.dirty = False
         try:
             if self.shelf[CSVShelf.VERSION] == CSVShelf.CURRENT:
@@ -849,6 +853,7 @@ class CSVShelf(object):
                     if not files or all(files[x] <= sfiles[x] for x in fnames):
                         # Todo correcto, los datos estan cargados
                         backup = self.shelf[CSVShelf.DATA]
+                        self.sources = self.shelf[CSVShelf.SOURCES]
                         # Convierto lo almacenado en el shelf en un DataObject
                         meta = backup['_meta']
                         data = CSVDataObject(meta)
@@ -870,6 +875,26 @@ class CSVShelf(object):
             lazy = False
         self._update(files, warnings=warnings, lazy=lazy)
 
+    def changed(self, datapath):
+        """Comprueba si los ficheros CSV han cambiado desde la ultima carga"""
+        return self.scan(datapath) != self.csvfiles
+
+    def scan(self, datapath):
+        """Devuelve los ficheros CSV del path, { ruta absoluta: mtime }"""
+        return dict(chain(*(self._findcsv(dirname) for dirname in datapath)))
+
+    def fingerprint(self, name):
+        """Devuelve una huella de los ficheros de los que depende un dato.
+
+        "name" es el nombre de una tabla de primer nivel o de una variable.
+        La huella es una tupla de pares (fichero, mtime), o None si el
+        nombre no corresponde a ningun dato cargado de los CSV.
+        """
+        files = self.sources.get(name, None)
+        if files is None:
+            return None
+        return tuple(sorted((f, self.csvfiles.get(f, None)) for f in files))
+
     def dump_warnings(self, warnings):
         if not warnings:
             return
@@ -902,6 +927,7 @@ class CSVShelf(object):
                     item.prepare(meta)
                 except:
                     raise DataError(item.source, item.index)
+        sources = self._sources(nesting)
         # ejecuto la carga de datos (solo de las tablas de primer nivel,
         # el resto se carga bajo demanda)
         data = CSVDataObject(meta)
@@ -913,10 +939,10 @@ class CSVShelf(object):
             # tabla vacia, subtype.process no hace nada.
             # data.get(key)
         # Proceso la tabla de variables
-        self._set_vars(data, warnings)
+        self._set_vars(data, warnings, sources)
         # OK, todo cargado... ahora guardo los datos en el shelf.
         data.PK = CSVDataObject.next()
-        self._save(files, data.__dict__)
+        self._save(files, data.__dict__, sources)
 
     def _read_blocks(self, files):
         """Carga los ficheros y genera los bloques de datos"""
@@ -926,7 +952,30 @@ class CSVShelf(object):
             nesting.setdefault(block.depth, list()).append(block)
         return nesting
 
-    def _set_vars(self, data, warnings=None):
+    def _sources(self, nesting):
+        """Calcula de que ficheros CSV depende cada tabla de primer nivel.
+
+        Los enlaces relacionan objetos de tablas distintas (a traves del
+        PEER se puede llegar de una a otra), asi que las tablas unidas por
+        algun enlace comparten todos sus ficheros de origen.
+        """
+        merged = list()
+        for block in chain(*nesting.values()):
+            if isinstance(block, LinkBlock):
+                roots = set(group.path[0] for group in block.groups)
+            else:
+                roots = set((block.path[0],))
+            files = set((block.source,))
+            for other in tuple(merged):
+                if not roots.isdisjoint(other[0]):
+                    merged.remove(other)
+                    roots.update(other[0])
+                    files.update(other[1])
+            merged.append((roots, files))
+        return dict((root, frozenset(files))
+            for (roots, files) in merged for root in roots)
+
+    def _set_vars(self, data, warnings=None, sources=None):
         # proceso la tabla especial "variables"
         meta = data._meta
         keys = dict((k.lower(), k) for k in meta.subtypes.keys())
@@ -945,6 +994,8 @@ class CSVShelf(object):
                     if vval is not None:
                         setattr(data, vname, vval)
                         meta.fields[vname] = vtyp
+                        if sources is not None:
+                            sources[vname] = sources.get(vart, frozenset())
                     elif vwarn and (warnings is not None):
                         warnings.append((vname, vwarn))
                         vwarn = list()
@@ -952,9 +1003,11 @@ class CSVShelf(object):
             del(meta.fields[vart])
             del(meta.subtypes[vart])
 
-    def _save(self, files, data):
+    def _save(self, files, data, sources):
         self.data = dict(data) # hago una copia
+        self.sources = sources
         self.shelf[CSVShelf.VERSION] = CSVShelf.CURRENT
         self.shelf[CSVShelf.DATA] = data
         self.shelf[CSVShelf.FILES] = files
+        self.shelf[CSVShelf.SOURCES] = sources
         self.dirty = True
@@ -5,6 +5,9 @@
 import os
 import os.path
 import sys
+import hashlib
+import fnmatch
+import multiprocessing
 try:
     import cPickle as pickle
 except ImportError:
@@ -12,12 +15,20 @@ except ImportError:
 
 from contextlib import contextmanager
 
-from cuac.libs.pathfinder import PathFinder, FileSource
+try:
+    from collections import OrderedDict
+except ImportError:
+    from cuac.libs.odict import OrderedDict
+
+from cuac.libs.pathfinder import PathFinder, FileSource, DirCache
 from cuac.libs.ciscopw import password, secret
 from cuac.libs.alcatelpw import snmpHash
 from cuac.libs.meta import DataSet
 from cuac.libs.csvreader import CSVShelf
-from cuac.libs.templite import Templite
+from cuac.libs.templite import Templite, ParseError
+from cuac.libs.memo import Memo, CACHED, load_key
+from cuac.tools.dot import DotFilter
+from cuac.tools.yed import load_shapes, dump_shapes
 
 
 class PathElem(str):
@@ -32,9 +43,37 @@ class PathElem(str):
         return PathElem(os.path.join(self, *elems))
 
 
+def _compile(args):
+    """Compila una plantilla. Se ejecuta en un proceso aparte.
+
+    Devuelve la tupla (ruta, plantilla, error). Los errores se devuelven
+    como texto, porque el traceback no se puede pasar a otro proceso.
+    """
+    source, mtime = args
+    try:
+        return (source, Templite(source, FileSource(source).read(), timestamp=mtime), None)
+    except ParseError as details:
+        return (source, None, str(details))
+    except Exception as details:
+        return (source, None, "Error leyendo %s: %s" % (source, str(details)))
+
+
 class ShelfLoader(CSVShelf):
 
     FILES    = "tmpl_files"
+    DIRS     = "tmpl_dirs"
+    PATHS    = "tmpl_paths"
+    RENDERS  = "tmpl_renders"
+    MEMOS    = "tmpl_memos_hmac"
+    # Versiones anteriores, con los argumentos en claro o con un hash
+    # sin clave (ver "close").
+    OLDMEMOS = ("tmpl_memos", "tmpl_memos_sha256")
+    # Funciones cuyos resultados se guardan en el shelf. CISCOPASSWORD no:
+    # es barata de calcular, y su resultado (tipo 7) es reversible.
+    PERSISTED = ("CISCOSECRET", "ALUSNMPHASH")
+    GRAPHVIZ = "tmpl_graphviz"
+    DIAGRAMS = "tmpl_diagrams"
+    SHAPES   = "tmpl_shapes"
     VERSION  = "tmpl_version"
     CURRENT  = 1
 
@@ -54,9 +93,15 @@ class ShelfLoader(CSVShelf):
             pass
         super(ShelfLoader, self).__init__(shelf)
         self.files, self.dirty = None, False
+        dirs, self.paths, self.renders = None, None, None
         try:
             if self.shelf[ShelfLoader.VERSION] == ShelfLoader.CURRENT:
                 self.files = self.shelf[ShelfLoader.FILES]
+                # Los listados de directorio y las rutas resueltas se
+                # agregaron despues, puede que el shelf no los tenga.
+                dirs = self.shelf.get(ShelfLoader.DIRS, None)
+                self.paths = self.shelf.get(ShelfLoader.PATHS, None)
+                self.renders = self.shelf.get(ShelfLoader.RENDERS, None)
         except KeyError:
             pass
         if self.files is None:
@@ -64,24 +109,63 @@ class ShelfLoader(CSVShelf):
             # (cualquiera que sea el error)
             self.files = dict()
             self.dirty = True
+        if self.paths is None:
+            self.paths = dict()
+        if self.renders is None:
+            self.renders = dict()
+        self.dircache = DirCache(dirs)
+        self.mtimes = dict()
+        # Los resultados de las funciones puras no dependen de la version
+        # del shelf, los recupero siempre que esten.
+        # Las entradas se guardan con un HMAC de los argumentos, no con
+        # los argumentos (contrasenas) en claro, ver Memo.dump. La clave
+        # esta fuera del shelf; si aun no existe, se crea al guardar.
+        memos, key = self.shelf.get(ShelfLoader.MEMOS, None) or dict(), load_key()
+        # CISCOPASSWORD y CISCOSECRET sin semilla o salt explicita son
+        # aleatorias, esas llamadas no se cachean.
+        self.memos = dict((name, Memo(func, items=memos.get(name, None), explicit=explicit, key=key))
+            for (name, func, explicit) in (
+                ("CISCOPASSWORD", password, ("seed",)),
+                ("CISCOSECRET", secret, ("salt",)),
+                ("ALUSNMPHASH", snmpHash, ()),
+            ))
+        self.keep_memos = False
+        # En los procesos hijos (ver Consumer.batch) no se guarda el
+        # shelf, para que no se pisen unos a otros.
+        self.readonly = False
         self.glob = {
-            "CISCOPASSWORD": password,
-            "CISCOSECRET": secret,
-            "ALUSNMPHASH": snmpHash,
+            "CACHED": CACHED,
             "ANY": DataSet.ANY,
             "NONE": DataSet.NONE,
         }
+        self.glob.update(self.memos)
         self.cache = dict()
+        # Los ejecutables de Graphviz tampoco dependen de la version.
+        DotFilter.load_paths(self.shelf.get(ShelfLoader.GRAPHVIZ, None))
+        DotFilter.JOBS.load(self.shelf.get(ShelfLoader.DIAGRAMS, None))
+        load_shapes(self.shelf.get(ShelfLoader.SHAPES, None))
 
     def set_tmplpath(self, tmplpath):
         """Prepara la carga de plantillas del path"""
-        self.path = PathFinder(tmplpath)
+        self.path = PathFinder(tmplpath, self.dircache)
+        # Las rutas resueltas dependen del path, lo incluyo en la clave.
+        self.pathkey = tuple(os.path.abspath(x) for x in self.path)
 
     def set_datapath(self, datapath, warnings=None, lazy=True):
         """ejecuta la carga de datos"""
         super(ShelfLoader, self).set_datapath(datapath, warnings=warnings, lazy=lazy)
         self.data.update(self.glob)
 
+    def refresh(self):
+        """Olvida las comprobaciones hechas en esta ejecucion.
+
+        Para procesos de larga duracion: las plantillas, rutas y
+        directorios se vuelven a validar la proxima vez que se usen.
+        """
+        self.cache = dict()
+        self.mtimes = dict()
+        self.dircache.checked = dict()
+
     def add_symbols(self, symbols):
         """Agrega simbolos al espacio global de los templates"""
         self.data.update(symbols)
@@ -94,28 +178,130 @@ class ShelfLoader(CSVShelf):
             return self.cache[(tmplname, hint)]
         except KeyError:
             pass
-        if hint:
-            # buscamos primero en la misma ruta que el fichero que nos
-            # dan como pista
-            self.path.insert(0, os.path.dirname(hint))
-        source = self.path(tmplname)
+        source = self._resolve(tmplname, hint)
         template = self.files.get(source, None)
-        mtime = os.stat(source).st_mtime
+        mtime = self._mtime(source)
         if template is None or template.timestamp < mtime:
             self.dirty = True
             template = Templite(source, FileSource(source).read(), timestamp=mtime)
             self.files[source] = template
         return self.cache.setdefault((tmplname, hint), (source, template))
 
+    def precompile(self, dirnames, patterns=("*.txt",), processes=None):
+        """Compila por adelantado las plantillas de los directorios dados.
+
+        Compila, en paralelo, los ficheros de los directorios cuyo nombre
+        coincida con alguno de los patrones, si no estan ya compilados en
+        el shelf. No se recorre el path entero porque siempre incluye el
+        directorio actual, que puede tener otros ficheros .txt.
+
+        Devuelve una tupla (plantillas, compiladas, errores), donde
+        "errores" es una lista con el texto de cada error.
+        """
+        sources = set()
+        for dirname in dirnames:
+            for fname in self.dircache.listing(dirname):
+                if any(fnmatch.fnmatch(fname, x) for x in patterns):
+                    sources.add(os.path.abspath(os.path.join(dirname, fname)))
+        stale = list()
+        for source in sorted(sources):
+            template, mtime = self.files.get(source, None), self._mtime(source)
+            if template is None or template.timestamp < mtime:
+                stale.append((source, mtime))
+        if processes == 1 or len(stale) < 2:
+            results = map(_compile, stale)
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_compile, stale)
+            finally:
+                pool.close()
+                pool.join()
+        errors = list()
+        for source, template, error in results:
+            if template is None:
+                errors.append(error)
+            else:
+                self.files[source] = template
+                self.dirty = True
+        return (len(sources), len(stale), errors)
+
+    def locate(self, tmplname, hint=None):
+        """Devuelve la ruta de la plantilla y su mtime, sin compilarla.
+
+        Si la plantilla no se encuentra, lanza un ValueError.
+        """
+        source = self._resolve(tmplname, hint)
+        return (source, self._mtime(source))
+
+    def _resolve(self, tmplname, hint=None):
+        """Localiza el fichero de la plantilla en el path.
+
+        Si hay pista, se busca primero en el directorio de la plantilla que
+        nos dan como pista. Las rutas resueltas se guardan en el shelf,
+        junto con el mtime de los directorios consultados; mientras esos
+        directorios no cambien, la ruta guardada sigue siendo valida.
+        """
+        first = os.path.dirname(hint) if hint else None
+        key = (tmplname, first, self.pathkey)
+        mtime = self.dircache.mtime
+        try:
+            source, depends = self.paths[key]
+            if all(mtime(d) == m for (d, m) in depends):
+                return source
+        except KeyError:
+            pass
+        source, depends = self.path.locate(tmplname, first)
+        if depends is not None:
+            self.paths[key] = (source, depends)
+            self.dirty = True
+        return source
+
+    def _mtime(self, source):
+        """Devuelve el mtime de un fichero, consultandolo solo una vez"""
+        try:
+            return self.mtimes[source]
+        except KeyError:
+            return self.mtimes.setdefault(source, os.stat(source).st_mtime)
+
     def persist(self):
         """Obliga a que se guarden cambios en los datos"""
         self.shelf[CSVShelf.DATA] = self.data
         self.dirty = True
 
     def close(self):
+        if self.readonly:
+            return
         try:
-            if self.dirty:
+            for oldmemos in ShelfLoader.OLDMEMOS:
+                if self.shelf.pop(oldmemos, None) is not None:
+                    # Borro las caches de versiones anteriores, con las
+                    # contrasenas en claro o faciles de atacar.
+                    self.dirty = True
+            if self.keep_memos and any(self.memos[x].dirty for x in ShelfLoader.PERSISTED):
+                key = load_key(create=True)
+                if key:
+                    for name in ShelfLoader.PERSISTED:
+                        self.memos[name].key = key
+                    self.shelf[ShelfLoader.MEMOS] = dict((x, self.memos[x].dump()) for x in ShelfLoader.PERSISTED)
+                    self.dirty = True
+            graphviz = DotFilter.dump_paths()
+            if graphviz is not None and graphviz != self.shelf.get(ShelfLoader.GRAPHVIZ, None):
+                self.shelf[ShelfLoader.GRAPHVIZ] = graphviz
+                self.dirty = True
+            diagrams = DotFilter.JOBS.dump()
+            if diagrams is not None:
+                self.shelf[ShelfLoader.DIAGRAMS] = diagrams
+                self.dirty = True
+            shapes = dump_shapes()
+            if shapes and shapes != self.shelf.get(ShelfLoader.SHAPES, None):
+                self.shelf[ShelfLoader.SHAPES] = shapes
+                self.dirty = True
+            if self.dirty or self.dircache.dirty:
                 self.shelf[ShelfLoader.FILES] = self.files
+                self.shelf[ShelfLoader.DIRS] = dict(self.dircache)
+                self.shelf[ShelfLoader.PATHS] = self.paths
+                self.shelf[ShelfLoader.RENDERS] = self.renders
                 self.shelf[ShelfLoader.VERSION] = ShelfLoader.CURRENT
                 with open(self.shelfname, "wb") as shelve:
                     pickle.dump(self.shelf, shelve, protocol=2)
@@ -124,11 +310,77 @@ class ShelfLoader(CSVShelf):
             pass
 
 
+def _digest(fname, blocksize=1 << 16):
+    """Calcula el hash md5 del contenido de un fichero"""
+    digest = hashlib.md5()
+    with open(fname, "rb") as infile:
+        for block in iter(lambda: infile.read(blocksize), ""):
+            digest.update(block)
+    return digest.digest()
+
+
+def _replace(source, dest):
+    """Renombra source como dest, reemplazandolo si existe"""
+    try:
+        os.rename(source, dest)
+    except OSError:
+        # En windows, rename falla si el destino existe.
+        os.unlink(dest)
+        os.rename(source, dest)
+
+
+class OutputPool(object):
+
+    """Pool de ficheros de salida abiertos.
+
+    Mantiene abiertos, con un buffer de escritura grande, los ultimos
+    ficheros de salida utilizados. Asi los SAVEAS o el modo --onefile, que
+    escriben muchas veces en el mismo fichero, no tienen que abrirlo y
+    cerrarlo cada vez.
+
+    Si hay demasiados ficheros abiertos, se cierra el que lleve mas tiempo
+    sin usarse. Los ficheros se identifican por su ruta absoluta.
+    """
+
+    MAXOPEN = 32
+    BUFSIZE = 1 << 20
+
+    def __init__(self, maxopen=None, bufsize=None):
+        self.maxopen = maxopen or OutputPool.MAXOPEN
+        self.bufsize = bufsize or OutputPool.BUFSIZE
+        self.handles = OrderedDict()
+
+    def get(self, outname):
+        """Devuelve un fichero abierto en modo "append" """
+        outname = os.path.abspath(outname)
+        try:
+            handle = self.handles.pop(outname)
+        except KeyError:
+            if len(self.handles) >= self.maxopen:
+                self.handles.popitem(last=False)[1].close()
+            handle = open(outname, "a", self.bufsize)
+        # Lo vuelvo a meter, para que quede el ultimo en la lista LRU.
+        self.handles[outname] = handle
+        return handle
+
+    def discard(self, outname):
+        """Cierra el fichero, si estaba abierto"""
+        handle = self.handles.pop(os.path.abspath(outname), None)
+        if handle is not None:
+            handle.close()
+
+    def close(self):
+        """Vuelca y cierra todos los ficheros abiertos"""
+        handles, self.handles = self.handles, OrderedDict()
+        for handle in handles.itervalues():
+            handle.close()
+
+
 class ContextMaker(object):
 
     """Genera contextos que dirigen la salida al fichero adecuado"""
 
-    def __init__(self, outpath=".", ext=".cfg", collapse=False, overwrite=True):
+    def __init__(self, outpath=".", ext=".cfg", collapse=False, overwrite=True, onchange=False):
         """Prepara el generador.
         
         - outpath: directorio de salida (si collapse == False), o nombre del
@@ -137,11 +389,21 @@ class ContextMaker(object):
         - ext: extension que se le pone a los ficheros de salida.
         
         - output_dir: directorio de salida, sea collapse True o False.
+
+        - onchange: si es True, los ficheros que se sobreescriben se
+            generan primero en un fichero temporal, y solo reemplazan al
+            original si su contenido es distinto.
         """
         self.outpath = outpath
         self.overwrite = overwrite
         self.collapse = collapse
         self.ext = ext
+        self.onchange = onchange
+        self.pool = OutputPool()
+        # ficheros temporales pendientes de comparar: { abspath: tmpname }
+        self.staged = dict()
+        # resultado de la comparacion: { abspath: True si ha cambiado }
+        self.status = dict()
         # Calculo el directorio de salida en funcion de los valores
         # de outpath y collapse.
         if collapse:
@@ -149,8 +411,8 @@ class ContextMaker(object):
                 self.output_dir = PathElem(os.getcwd())
             else:
                 self.output_dir = PathElem(os.path.dirname(self.outpath))
-                if self.overwrite and os.path.isfile(outpath):
-                    os.unlink(outpath)
+                if self.overwrite:
+                    self._reset(outpath)
             self.overwrite = False
         else:
             self.output_dir = PathElem(outpath or os.getcwd())
@@ -168,19 +430,102 @@ class ContextMaker(object):
             outpath = self.output_dir.join(outname)
         return outpath
 
-    def get_context(self, outname):
+    def get_context(self, outname, flush=False):
         """Obtiene un contexto de escritura al fichero 'outname'.
 
         'outname' es una ruta completa (o relativa a getcwd()), en ningun
         caso relativa a "output_dir".
+
+        El fichero no se cierra al salir del contexto, queda abierto en el
+        pool hasta que se invoque a "close". Si flush=True, el contenido se
+        vuelca a disco al salir del contexto (por ejemplo, porque otro
+        proceso tiene que leer el fichero a continuacion).
         """
         if self.overwrite:
-            if os.path.isfile(outname):
-                os.unlink(outname)
+            self._reset(outname)
+        key = os.path.abspath(outname)
+        @contextmanager
         def outcontext():
-            return open(outname, "a+")
+            outfile = self.pool.get(self.staged.get(key, key))
+            yield outfile
+            if flush:
+                outfile.flush()
+                # Si otro proceso va a leer el fichero, tiene que estar
+                # ya en su sitio.
+                self._commit(key)
         return outcontext
 
+    def _reset(self, outname):
+        """Descarta el contenido previo de un fichero que se va a reescribir"""
+        key = os.path.abspath(outname)
+        self.pool.discard(key)
+        staged = self.staged.pop(key, None)
+        # El temporal se registra al resetear, pero no se crea hasta que
+        # se escribe algo: puede no existir.
+        if staged is not None:
+            self.pool.discard(staged)
+            if os.path.isfile(staged):
+                os.unlink(staged)
+        if self.onchange:
+            staged = "%s.%d.tmp" % (key, os.getpid())
+            if os.path.isfile(staged):
+                os.unlink(staged)
+            self.staged[key] = staged
+        elif os.path.isfile(outname):
+            os.unlink(outname)
+
+    def _commit(self, key):
+        """Reemplaza el fichero por su temporal, si el contenido es distinto"""
+        staged = self.staged.pop(key, None)
+        if staged is None:
+            return
+        self.pool.discard(staged)
+        if not os.path.isfile(staged):
+            # No se llego a escribir nada.
+            open(staged, "a").close()
+        if os.path.isfile(key) and _digest(key) == _digest(staged):
+            os.unlink(staged)
+            self.status[key] = False
+        else:
+            _replace(staged, key)
+            self.status[key] = True
+
+    def close(self, commit=True):
+        """Vuelca y cierra todos los ficheros de salida.
+
+        Si commit=False, los ficheros temporales pendientes se descartan
+        y los ficheros originales se quedan como estaban.
+        """
+        self.pool.close()
+        for key in tuple(self.staged):
+            if commit:
+                self._commit(key)
+            else:
+                staged = self.staged.pop(key)
+                if os.path.isfile(staged):
+                    os.unlink(staged)
+
+    def dump_summary(self):
+        """Muestra un resumen de los ficheros modificados"""
+        if not self.status:
+            return
+        changed = sorted(k for (k, v) in self.status.iteritems() if v)
+        print "Ficheros de salida: %d modificados, %d sin cambios" % (
+            len(changed), len(self.status) - len(changed))
+        for outname in changed:
+            print "  %s" % outname
+
+    def get_outname(self, tmplname, outname=None):
+        """Devuelve la ruta del fichero de salida de una plantilla.
+
+        Si se da "outname", es una ruta relativa al output_dir. Si no, el
+        nombre se calcula a partir del de la plantilla. Devuelve None si
+        la salida es stdout.
+        """
+        if outname is not None:
+            return self.resolve_relative(outname)
+        return self._outname(tmplname)
+
     def resolve_relative(self, outname):
         """Resuelve un nombre de fichero relativo al dir. de salida"""
         # Por si el nombre de salida viene con directorio... puede venir
@@ -286,3 +631,126 @@ class Interactor(object):
                 item.exhausted = True
         self.path = []
         return self.tree.exhausted
+
+
+if __name__ == "__main__":
+
+    import unittest
+    import shutil
+    import tempfile
+
+    class TestOutputPool(unittest.TestCase):
+
+        def setUp(self):
+            self.tmpdir = tempfile.mkdtemp()
+            self.pool = OutputPool(maxopen=2)
+
+        def tearDown(self):
+            self.pool.close()
+            shutil.rmtree(self.tmpdir)
+
+        def path(self, name):
+            return os.path.join(self.tmpdir, name)
+
+        def read(self, name):
+            with open(self.path(name)) as infile:
+                return infile.read()
+
+        def testReuse(self):
+            """El mismo fichero devuelve el mismo handle"""
+            handle = self.pool.get(self.path("a"))
+            self.failUnless(self.pool.get(self.path("a")) is handle)
+
+        def testLRU(self):
+            """Al pasar de maxopen se cierra el menos usado recientemente"""
+            a = self.pool.get(self.path("a"))
+            b = self.pool.get(self.path("b"))
+            self.pool.get(self.path("a"))
+            self.pool.get(self.path("c"))
+            self.failUnless(b.closed)
+            self.failIf(a.closed)
+            self.assertEqual(len(self.pool.handles), 2)
+
+        def testAppend(self):
+            """Un fichero cerrado por el LRU se reabre sin perder datos"""
+            self.pool.get(self.path("a")).write("1")
+            self.pool.get(self.path("b")).write("2")
+            self.pool.get(self.path("c")).write("3")
+            self.pool.get(self.path("a")).write("4")
+            self.pool.close()
+            self.assertEqual(self.read("a"), "14")
+
+        def testBuffer(self):
+            """La escritura se retiene hasta que se cierra el pool"""
+            self.pool.get(self.path("a")).write("hola")
+            self.assertEqual(self.read("a"), "")
+            self.pool.close()
+            self.assertEqual(self.read("a"), "hola")
+            self.assertEqual(len(self.pool.handles), 0)
+
+        def testDiscard(self):
+            """discard cierra el fichero y lo saca del pool"""
+            handle = self.pool.get(self.path("a"))
+            self.pool.discard(self.path("a"))
+            self.failUnless(handle.closed)
+            self.assertEqual(len(self.pool.handles), 0)
+
+    class TestContextMaker(unittest.TestCase):
+
+        def setUp(self):
+            self.tmpdir = tempfile.mkdtemp()
+            self.outname = os.path.join(self.tmpdir, "out.cfg")
+
+        def tearDown(self):
+            shutil.rmtree(self.tmpdir)
+
+        def read(self):
+            with open(self.outname) as infile:
+                return infile.read()
+
+        def testFlush(self):
+            """Con flush=True, el contenido esta en disco al salir"""
+            maker = ContextMaker(self.tmpdir)
+            with maker.get_context(self.outname, flush=True)() as outfile:
+                outfile.write("hola")
+            self.assertEqual(self.read(), "hola")
+            maker.close()
+
+        def testNoFlush(self):
+            """Sin flush, el contenido se vuelca al cerrar"""
+            maker = ContextMaker(self.tmpdir)
+            with maker.get_context(self.outname)() as outfile:
+                outfile.write("hola")
+            self.assertEqual(self.read(), "")
+            maker.close()
+            self.assertEqual(self.read(), "hola")
+
+        def testOnChange(self):
+            """Con onchange, el fichero solo se reemplaza si cambia"""
+            for text, changed in (("hola", True), ("hola", False), ("adios", True)):
+                maker = ContextMaker(self.tmpdir, onchange=True)
+                with maker.get_context(self.outname)() as outfile:
+                    outfile.write(text)
+                maker.close()
+                self.assertEqual(self.read(), text)
+                self.assertEqual(maker.status[self.outname], changed)
+            self.assertEqual(os.listdir(self.tmpdir), ["out.cfg"])
+
+        def testDiscardUnwritten(self):
+            """Se pueden descartar temporales en los que no se escribio"""
+            with open(self.outname, "w") as outfile:
+                outfile.write("original")
+            maker = ContextMaker(self.outname, collapse=True, onchange=True)
+            maker.get_context(self.outname)
+            maker.close(commit=False)
+            self.assertEqual(self.read(), "original")
+            self.assertEqual(os.listdir(self.tmpdir), ["out.cfg"])
+            # Y reescribir un fichero cuyo temporal no llego a crearse.
+            maker = ContextMaker(self.tmpdir, onchange=True)
+            maker.get_context(self.outname)
+            with maker.get_context(self.outname)() as outfile:
+                outfile.write("nuevo")
+            maker.close()
+            self.assertEqual(self.read(), "nuevo")
+
+    unittest.main()
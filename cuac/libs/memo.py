@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+
+import os
+import os.path
+import hmac
+import errno
+import hashlib
+
+from inspect import getargspec
+from itertools import chain
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from cuac.libs.odict import OrderedDict
+
+
+# Marca de "no esta en la cache" (None puede ser un resultado valido).
+_MISSING = object()
+
+# Fichero con la clave de los hashes de argumentos (ver Memo.digest).
+KEYFILE = os.environ.get("CUAC_MEMO_KEY",
+    os.path.join(os.path.expanduser("~"), ".cuac_memo_key"))
+KEYSIZE = 32
+
+
+def load_key(fname=None, create=False):
+    """Lee la clave de los hashes de argumentos.
+
+    Si el fichero no existe y create=True, lo crea con una clave al
+    azar, legible solo por el usuario. Devuelve None si no hay clave.
+    """
+    fname = fname or KEYFILE
+    try:
+        with open(fname, "rb") as infile:
+            key = infile.read()
+        return key if len(key) >= KEYSIZE else None
+    except IOError as details:
+        if details.errno != errno.ENOENT or not create:
+            return None
+    try:
+        fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    except OSError:
+        return None
+    key = os.urandom(KEYSIZE)
+    with os.fdopen(fd, "wb") as outfile:
+        outfile.write(key)
+    return key
+
+
+class Memo(object):
+
+    """
+    Memoiza una funcion pura, con una cache LRU acotada.
+
+    Guarda el resultado de las ultimas "maxsize" llamadas distintas.
+    Las llamadas con argumentos que no se pueden usar como clave de un
+    diccionario (listas, DataSets...) no se cachean.
+
+    Las funciones con una parte aleatoria (como CISCOSECRET sin salt)
+    no deben devolver siempre el mismo resultado: "explicit" es la lista
+    de argumentos que la fijan (la salt, la semilla...), y las llamadas
+    que no los dan (o los dan como None) no se cachean.
+
+    Lo que se guarda en el shelf (ver "dump") no incluye los argumentos,
+    solo un HMAC de ellos con una clave ("key") que se guarda fuera del
+    shelf: los argumentos pueden ser contrasenas, y un hash sin clave se
+    podria atacar por fuerza bruta. Esas entradas ("saved") solo se
+    consultan cuando la llamada no esta en la cache en memoria. Sin
+    clave, no se cargan ni se vuelcan entradas.
+    """
+
+    MAXSIZE = 4096
+
+    def __init__(self, func, maxsize=None, items=None, explicit=(), key=None):
+        self.func = func
+        # Posicion y nombre de cada argumento que hay que dar explicitamente
+        names = getargspec(func).args if explicit else ()
+        self.explicit = tuple((names.index(x), x) for x in explicit)
+        self.maxsize = maxsize or Memo.MAXSIZE
+        self.items = OrderedDict()
+        self.key = key
+        self.saved = OrderedDict((items or tuple()) if key else tuple())
+        self.dirty = False
+        self.__name__ = getattr(func, "__name__", self.__class__.__name__)
+        self.__doc__ = getattr(func, "__doc__", None)
+
+    def _random(self, args, kw):
+        """Comprueba si falta alguno de los argumentos "explicit" """
+        for pos, name in self.explicit:
+            value = args[pos] if pos < len(args) else kw.get(name, None)
+            if value is None:
+                return True
+        return False
+
+    def __call__(self, *args, **kw):
+        if self.explicit and self._random(args, kw):
+            return self.func(*args, **kw)
+        key = (args, tuple(sorted(kw.iteritems()))) if kw else args
+        try:
+            hash(key)
+        except TypeError:
+            # Argumentos no hashables
+            return self.func(*args, **kw)
+        value = self.items.pop(key, _MISSING)
+        if value is _MISSING:
+            value = self.saved.pop(self.digest(key), _MISSING) if self.saved else _MISSING
+            if value is _MISSING:
+                value = self.func(*args, **kw)
+                self.dirty = True
+            if len(self.items) >= self.maxsize:
+                self.items.popitem(last=False)
+        # Lo vuelvo a meter, para que quede el ultimo en la lista LRU.
+        self.items[key] = value
+        return value
+
+    def digest(self, key):
+        """HMAC de los argumentos de una llamada"""
+        return hmac.new(self.key, repr(key), hashlib.sha256).hexdigest()
+
+    def dump(self):
+        """Devuelve el contenido de la cache, para guardarlo en un shelf.
+
+        Es una tupla de pares (HMAC de los argumentos, resultado), con las
+        ultimas "maxsize" llamadas (incluidas las cargadas del shelf que
+        no se han usado en esta ejecucion). Si no hay clave, esta vacia.
+        """
+        if not self.key:
+            return tuple()
+        items = chain(self.saved.iteritems(),
+            ((self.digest(k), v) for (k, v) in self.items.iteritems()))
+        return tuple(items)[-self.maxsize:]
+
+
+def CACHED(func, maxsize=None):
+    """Decorador para memoizar funciones puras desde las plantillas.
+
+    Por ejemplo:
+
+    {{@CACHED
+      def vlan_name(vlan):
+          return "VLAN_%04d" % vlan
+    }}
+    """
+    return Memo(func, maxsize)
+
+
+if __name__ == "__main__":
+
+    import unittest
+    import shutil
+    import tempfile
+
+    class TestMemo(unittest.TestCase):
+
+        def setUp(self):
+            self.calls = list()
+
+        def double(self, x):
+            self.calls.append(x)
+            if x < 0:
+                raise TypeError(x)
+            return x * 2
+
+        def testCache(self):
+            """Cada llamada distinta se calcula una vez"""
+            memo = Memo(self.double)
+            self.assertEqual((memo(1), memo(1), memo(2)), (2, 2, 4))
+            self.assertEqual(self.calls, [1, 2])
+
+        def testLRU(self):
+            """Se descarta la llamada usada hace mas tiempo"""
+            memo = Memo(self.double, maxsize=2)
+            memo(1), memo(2), memo(1), memo(3), memo(1), memo(2)
+            self.assertEqual(self.calls, [1, 2, 3, 2])
+
+        def testUnhashable(self):
+            """Los argumentos no hashables no se cachean"""
+            memo = Memo(len)
+            self.assertEqual(memo([1, 2]), 2)
+            self.assertEqual(len(memo.items), 0)
+
+        def testTypeError(self):
+            """Un TypeError de la funcion se propaga, sin repetir la llamada"""
+            memo = Memo(self.double)
+            self.assertRaises(TypeError, memo, -1)
+            self.assertEqual(self.calls, [-1])
+
+        def testExplicit(self):
+            """Sin los argumentos explicitos no se cachea"""
+            def salted(x, salt=None):
+                self.calls.append(x)
+                return (x, salt)
+            memo = Memo(salted, explicit=("salt",))
+            memo(1), memo(1), memo(1, None), memo(1, salt=None)
+            self.assertEqual(len(self.calls), 4)
+            memo(1, "ab"), memo(1, salt="ab"), memo(1, "ab")
+            self.assertEqual(len(self.calls), 6)
+
+        def testSaved(self):
+            """Las entradas guardadas se recuperan por su HMAC"""
+            key = "k" * KEYSIZE
+            memo = Memo(self.double, key=key)
+            memo(1)
+            saved = memo.dump()
+            self.assertEqual([(len(k), v) for (k, v) in saved], [(64, 2)])
+            memo = Memo(self.double, items=saved, key=key)
+            self.assertEqual(memo(1), 2)
+            self.assertEqual(self.calls, [1])
+            # Con otra clave, o sin clave, no se recuperan.
+            memo = Memo(self.double, items=saved, key="x" * KEYSIZE)
+            memo(1)
+            self.assertEqual(self.calls, [1, 1])
+            memo = Memo(self.double, items=saved)
+            memo(1)
+            self.assertEqual(self.calls, [1, 1, 1])
+            self.assertEqual(memo.dump(), ())
+
+        def testKey(self):
+            """La clave se crea una vez, legible solo por el usuario"""
+            tmpdir = tempfile.mkdtemp()
+            try:
+                fname = os.path.join(tmpdir, "key")
+                self.failUnless(load_key(fname) is None)
+                key = load_key(fname, create=True)
+                self.assertEqual(len(key), KEYSIZE)
+                self.assertEqual(os.stat(fname).st_mode & 0777, 0600)
+                self.assertEqual(load_key(fname), key)
+            finally:
+                shutil.rmtree(tmpdir)
+
+    unittest.main()
@@ -7,6 +7,8 @@ import os.path
 import sys
 import codecs
 
+from itertools import chain
+
 try:
     import chardet
 except ImportError:
@@ -131,6 +133,61 @@ class StringSource(InputSource):
         return self.stream
 
 
+class DirCache(dict):
+
+    """Cache de listados de directorio.
+
+    Guarda, para cada directorio (ruta absoluta), una tupla (mtime, ficheros)
+    con la fecha de modificacion del directorio y el conjunto de ficheros
+    que contiene. Es un dict normal, para que se pueda guardar en el shelf
+    y reutilizar entre ejecuciones.
+
+    Cada directorio se valida con un solo os.stat la primera vez que se
+    consulta en la ejecucion actual. Si su mtime no ha cambiado, el listado
+    guardado sigue siendo valido (crear o borrar ficheros cambia el mtime
+    del directorio), y comprobar si un fichero existe se reduce a buscarlo
+    en un frozenset.
+    """
+
+    def __init__(self, listings=None):
+        super(DirCache, self).__init__(listings or tuple())
+        # mtimes de los directorios, validados en esta ejecucion.
+        self.checked = dict()
+        self.dirty = False
+
+    def mtime(self, dirname):
+        """Devuelve el mtime del directorio, o None si no existe"""
+        try:
+            return self.checked[dirname]
+        except KeyError:
+            pass
+        try:
+            mtime = os.stat(dirname).st_mtime
+        except OSError:
+            mtime = None
+        return self.checked.setdefault(dirname, mtime)
+
+    def listing(self, dirname):
+        """Devuelve el conjunto de ficheros del directorio"""
+        mtime = self.mtime(dirname)
+        if mtime is None:
+            return frozenset()
+        cached = self.get(dirname, None)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        # No tenemos os.scandir en python 2, asi que el tipo de cada
+        # entrada hay que averiguarlo a mano. Da igual, solo se hace
+        # cuando el directorio cambia.
+        try:
+            names = frozenset(x for x in os.listdir(dirname)
+                if os.path.isfile(os.path.join(dirname, x)))
+        except OSError:
+            names = frozenset()
+        self[dirname] = (mtime, names)
+        self.dirty = True
+        return names
+
+
 class PathFinder(list):
 
     """Localizador de ficheros
@@ -138,10 +195,15 @@ class PathFinder(list):
     Busca ficheros en un path determinado.
     """
 
-    def __init__(self, path=None):
-        """Establece el path de busqueda."""
+    def __init__(self, path=None, dircache=None):
+        """Establece el path de busqueda.
+
+        Si se le pasa un DirCache, lo utiliza para no tener que consultar
+        el sistema de ficheros en cada busqueda.
+        """
         super(PathFinder, self).__init__(path or [])
         self.insert(0, ".")
+        self.dircache = dircache
 
     def __call__(self, fname):
         """Busca el fichero en la ruta definida
@@ -154,11 +216,52 @@ class PathFinder(list):
         except StopIteration:
             raise ValueError("File %s not found in %s" % (fname, os.pathsep.join(self)))
 
-    def every(self, fname):
-        """Itera sobre todos los ficheros coincidentes en la ruta definida"""
-        for fpath in (os.path.join(dir, fname) for dir in self):
-            if os.path.isfile(fpath):
-                yield os.path.abspath(fpath)
+    def every(self, fname, first=None):
+        """Itera sobre todos los ficheros coincidentes en la ruta definida
+
+        Si se especifica "first", se busca en ese directorio antes que en
+        ningun otro, sin modificar el path.
+        """
+        for dirname in self.order(first):
+            if self._exists(dirname, fname):
+                yield os.path.abspath(os.path.join(dirname, fname))
+
+    def order(self, first=None):
+        """Devuelve el orden de busqueda, dando preferencia a "first" """
+        if not first:
+            return tuple(self)
+        return tuple(chain((first,), (x for x in self if x != first)))
+
+    def locate(self, fname, first=None):
+        """Busca el fichero y devuelve los directorios consultados.
+
+        Devuelve una tupla (path completo, dependencias), donde las
+        dependencias son pares (directorio, mtime) de todos los directorios
+        en los que se ha buscado, hasta encontrar el fichero. Mientras
+        ninguno de esos directorios cambie, el resultado de la busqueda
+        sera el mismo.
+
+        Si el nombre incluye directorios, o no hay DirCache, las
+        dependencias son None (el resultado no se puede validar solo con
+        los directorios del path).
+        """
+        depends, dircache = list(), self.dircache
+        if dircache is None or os.path.dirname(fname):
+            depends = None
+        for dirname in self.order(first):
+            if depends is not None:
+                dirname = os.path.abspath(dirname)
+                depends.append((dirname, dircache.mtime(dirname)))
+            if self._exists(dirname, fname):
+                fpath = os.path.abspath(os.path.join(dirname, fname))
+                return (fpath, tuple(depends) if depends is not None else None)
+        raise ValueError("File %s not found in %s" % (fname, os.pathsep.join(self)))
+
+    def _exists(self, dirname, fname):
+        """Comprueba si el fichero existe en el directorio"""
+        if self.dircache is None or os.path.dirname(fname):
+            return os.path.isfile(os.path.join(dirname, fname))
+        return fname in self.dircache.listing(os.path.abspath(dirname))
 
     def insert(self, pos, item):
         """Si el objeto ya estaba en la lista, lo cambia"""
@@ -169,4 +272,4 @@ class PathFinder(list):
         super(PathFinder, self).insert(pos, item)
 
     def __getslice__(self, i, j):
-        return PathFinder(super(PathFinder, self).__getslice__(i, j))
+        return PathFinder(super(PathFinder, self).__getslice__(i, j), self.dircache)
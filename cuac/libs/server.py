@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+
+import os
+import os.path
+import hmac
+import logging
+import urlparse
+import binascii
+import BaseHTTPServer
+
+
+DEFAULT_PORT = 7788
+
+# Cabecera HTTP con el token de acceso.
+TOKEN_HEADER = "X-Cuac-Token"
+
+
+class RenderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """
+    Atiende peticiones de renderizado.
+
+    Solo acepta POST (application/x-www-form-urlencoded) a "/render", con
+    el token del servidor en la cabecera X-Cuac-Token, y los parametros:
+
+    - template: nombre de la plantilla, relativo a algun directorio del
+        path de plantillas.
+    - D: definicion "VAR=VALOR", como la opcion -D, pero el valor debe ser
+        un literal de python (numero, cadena entre comillas, tupla...), no
+        se evalua como expresion. Puede repetirse.
+
+    La respuesta es texto plano con lo que la ejecucion escribe en
+    stdout: la salida de la plantilla, si no se ha dado un directorio de
+    salida, y los resumenes. Si hay un error, se devuelve con codigo 500.
+    """
+
+    def do_GET(self):
+        # Un GET se puede provocar desde cualquier pagina web abierta en
+        # el navegador, no lo acepto.
+        self.send_error(405, "Solo se admite POST")
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != "/render":
+            self.send_error(404)
+            return
+        if not self.server.authorized(self.headers.getheader(TOKEN_HEADER)):
+            self.send_error(403, "Token incorrecto")
+            return
+        length = int(self.headers.getheader("content-length") or 0)
+        params = urlparse.parse_qs(self.rfile.read(length))
+        template = params.get("template", (None,))[0]
+        if not template:
+            self.send_error(400, "Falta el parametro 'template'")
+            return
+        if not self.server.allowed(template):
+            self.send_error(404, "Plantilla no encontrada en el path")
+            return
+        status, body = self.server.render(template, params.get("D", []))
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info("%s %s", self.address_string(), format % args)
+
+
+class RenderServer(BaseHTTPServer.HTTPServer):
+
+    """
+    Servidor de renderizado.
+
+    Mantiene en memoria un Consumer ya preparado (datos cargados y
+    plantillas compiladas), y lo reutiliza en cada peticion: solo se
+    recarga lo que haya cambiado en disco (ver Consumer.reload).
+
+    Las peticiones se atienden de una en una, y el servidor solo escucha
+    en localhost. Ademas, cada peticion debe llevar el token del servidor
+    (si no se da uno, se genera al azar), solo se pueden ejecutar
+    plantillas del path, y las definiciones solo admiten valores
+    literales. Las plantillas siguen pudiendo ejecutar cualquier codigo
+    python, asi que el path de plantillas debe ser de confianza.
+    """
+
+    def __init__(self, consumer, port=DEFAULT_PORT, host="127.0.0.1", token=None):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), RenderHandler)
+        self.consumer = consumer
+        self.token = token or binascii.hexlify(os.urandom(16))
+
+    def authorized(self, token):
+        """Comprueba el token de una peticion"""
+        return bool(token) and hmac.compare_digest(str(token), self.token)
+
+    def allowed(self, template):
+        """Comprueba que la plantilla esta dentro del path de plantillas.
+
+        No se admiten rutas absolutas ni que suban de directorio, y la
+        ruta resuelta (siguiendo enlaces) debe estar en alguno de los
+        directorios del path.
+        """
+        if os.path.isabs(template) or os.path.splitdrive(template)[0]:
+            return False
+        if os.pardir in os.path.normpath(template).split(os.sep):
+            return False
+        try:
+            source = os.path.realpath(self.consumer.loader.locate(template)[0])
+        except (ValueError, OSError):
+            return False
+        for dirname in self.consumer.loader.path:
+            dirname = os.path.join(os.path.realpath(dirname), "")
+            if source.startswith(dirname):
+                return True
+        return False
+
+    def render(self, template, definitions):
+        """Ejecuta una plantilla. Devuelve (codigo HTTP, texto)"""
+        output, error = self.consumer.run(template, definitions, literals=True)
+        if error is not None:
+            return (500, output + error)
+        return (200, output)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 
-import sys, re, copy, ast
+import sys, re, copy, ast, types, time, imp, marshal
 import os.path
 
 from itertools import izip, cycle, chain
@@ -13,8 +13,6 @@ try:
 except ImportError:
     import pickle
 
-from cuac.libs.oset import OrderedSet
-
 
 def add_error(errlist, template, filename, lineno, exc_info):
     """Da formato a un mensaje de error provocado por una plantilla"""
@@ -104,7 +102,7 @@ class Accumulator(object):
     """
 
     def __init__(self, consumer):
-        self.stack, self.current = list(), list()
+        self.stack, self.current = list(), self._buffer()
         self.group = None
         self.consumer = consumer
 
@@ -118,7 +116,7 @@ class Accumulator(object):
             self.group.append(self.current)
             self.stack.append(self.group)
         self.group = list()
-        self.current = list()
+        self.current = self._buffer()
         
     def refresh(self):
         """Refrescamos el bloque actual"""
@@ -126,7 +124,7 @@ class Accumulator(object):
             self.consumer.send("".join(self.current))
         else:
             self.group.append(self.current)
-        self.current = list()
+        self.current = self._buffer()
 
     def collect(self):
         """Obtiene el grupo actual de datos"""
@@ -150,7 +148,7 @@ class Accumulator(object):
             self.group = self.stack.pop()
             self.current = self.group.pop()
         else:
-            self.current = list()
+            self.current = self._buffer()
             self.group = None
         return result
 
@@ -160,7 +158,150 @@ class Accumulator(object):
             self.current.append(string)
         return self
 
+    def _buffer(self):
+        """Crea una nueva lista interna"""
+        return list()
+
+
+class ProfiledAccumulator(Accumulator):
+
+    """Acumulador instrumentado.
+
+    Se comporta como un Accumulator, pero ademas:
+
+    - Cuenta los bytes y trozos de texto que emite cada linea de la
+        plantilla traducida, y la profundidad de bloques maxima a la
+        que lo hace.
+    - Cronometra cada bloque (desde el push hasta el pop).
+
+    Los bloques se identifican por la linea que hace el push. Con "dump"
+    se vuelcan los resultados, incluyendo perfiles en formato "folded"
+    (una linea por pila de bloques, seguida del valor), que es el que
+    usan las herramientas de flame graphs.
+    """
+
+    class Buffer(list):
+
+        """Lista interna que informa de cada cadena que se le agrega.
+
+        Hace falta porque la plantilla compilada puede usar directamente
+        "_out.current.append" (ver Optimizer).
+        """
+
+        def __init__(self, notify):
+            super(ProfiledAccumulator.Buffer, self).__init__()
+            self.notify = notify
+
+        def append(self, string):
+            self.notify(sys._getframe(1), string)
+            list.append(self, string)
+
+    def __init__(self, consumer, clock=time.time):
+        self.lines = dict()    # { (fichero, linea): [bytes, trozos, profundidad] }
+        self.sizes = dict()    # { pila de bloques: bytes }
+        self.times = dict()    # { pila de bloques: tiempo propio, en segundos }
+        self.blocks = list()   # [ [inicio, tiempo de los hijos] ]
+        self.names = tuple()   # pila de bloques abiertos
+        self.clock = clock
+        super(ProfiledAccumulator, self).__init__(consumer)
+
+    def _buffer(self):
+        return ProfiledAccumulator.Buffer(self._notify)
+
+    def _name(self, frame):
+        return "%s:%d" % (os.path.basename(frame.f_code.co_filename), frame.f_lineno)
+
+    def _notify(self, frame, string):
+        """Anota una cadena emitida desde el frame dado"""
+        key = (frame.f_code.co_filename, frame.f_lineno)
+        stats = self.lines.get(key, None)
+        if stats is None:
+            stats = self.lines.setdefault(key, [0, 0, 0])
+        stats[0] += len(string)
+        stats[1] += 1
+        stats[2] = max(stats[2], len(self.blocks))
+        stack = self.names + (self._name(frame),)
+        self.sizes[stack] = self.sizes.get(stack, 0) + len(string)
+
+    def push(self):
+        self.names = self.names + (self._name(sys._getframe(1)),)
+        self.blocks.append([self.clock(), 0.0])
+        super(ProfiledAccumulator, self).push()
 
+    def pop(self):
+        result = super(ProfiledAccumulator, self).pop()
+        start, children = self.blocks.pop()
+        elapsed = self.clock() - start
+        self.times[self.names] = self.times.get(self.names, 0.0) + elapsed - children
+        if self.blocks:
+            self.blocks[-1][1] += elapsed
+        self.names = self.names[:-1]
+        return result
+
+    def __lshift__(self, string):
+        if string:
+            self._notify(sys._getframe(1), string)
+            list.append(self.current, string)
+        return self
+
+    def dump(self, prefix):
+        """Vuelca el perfil en tres ficheros:
+
+        - prefix.lines: bytes, trozos y profundidad maxima por linea.
+        - prefix.bytes.folded: bytes por pila de bloques.
+        - prefix.time.folded: tiempo propio (microsegundos) por pila
+            de bloques.
+        """
+        with open(prefix + ".lines", "w") as outfile:
+            outfile.write("fichero\tlinea\tbytes\ttrozos\tprofundidad\n")
+            for (fname, lineno), stats in sorted(self.lines.iteritems(), key=lambda x: -x[1][0]):
+                outfile.write("%s\t%d\t%d\t%d\t%d\n" % ((fname, lineno) + tuple(stats)))
+        with open(prefix + ".bytes.folded", "w") as outfile:
+            for stack, size in sorted(self.sizes.iteritems()):
+                outfile.write("%s %d\n" % (";".join(stack), size))
+        with open(prefix + ".time.folded", "w") as outfile:
+            for stack, elapsed in sorted(self.times.iteritems()):
+                outfile.write("%s %d\n" % (";".join(stack), int(elapsed * 1000000)))
+
+
+def code_names(code):
+    """Devuelve los nombres que usa un objeto code, y los anidados en el"""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(code_names(const))
+    return frozenset(names)
+
+
+def streaming(filt):
+    """Marca un filtro como "streaming" (ver FILTER)"""
+    filt.streaming = True
+    return filt
+
+
+def FILTER(strings, *filters):
+    """Aplica una cadena de filtros a la salida de un bloque.
+
+    Los filtros pueden ser de dos tipos:
+
+    - "streaming" (tienen el atributo "streaming" = True): aceptan
+        cualquier iterable, lo recorren una sola vez, y pueden devolver
+        otro iterable (por ejemplo, un generador).
+    - bloqueantes (el resto): reciben una tupla con todas las cadenas.
+
+    Las secuencias de filtros streaming se encadenan como generadores,
+    en una sola pasada y sin crear listas intermedias. Solo se
+    construye una tupla antes de un filtro bloqueante, y si la entrada
+    no era ya una lista o tupla.
+    """
+    for filt in filters:
+        if not (getattr(filt, "streaming", False) or isinstance(strings, (tuple, list))):
+            strings = tuple(strings)
+        strings = filt(strings)
+    return strings
+
+
+@streaming
 def SORT(strings):
     """Ordena los items"""
     return sorted(strings)
@@ -171,16 +312,376 @@ def REVERSE(strings):
     return reversed(strings)
 
 
+@streaming
 def UNIQ(strings):
     """Filtra los items y devuelve solo los unicos"""
-    return OrderedSet(strings)
+    seen = set()
+    for item in strings:
+        if item not in seen:
+            seen.add(item)
+            yield item
 
 
+@streaming
 def SKIP(strings):
     """Elimina la entrada"""
     return tuple()
 
 
+class LineProfiler(object):
+
+    """
+    Perfilador de lineas de plantilla.
+
+    Usa sys.settrace, pero solo sigue los frames del codigo de las
+    plantillas registradas (y de las funciones definidas en ellas), y
+    traduce los numeros de linea del codigo traducido a los de la
+    plantilla original.
+
+    Para cada linea de plantilla cuenta las veces que se ejecuta y el
+    tiempo acumulado hasta la siguiente linea del mismo frame (incluye,
+    por tanto, el tiempo de las funciones a las que llama).
+    """
+
+    def __init__(self, clock=time.time):
+        self.templates = dict()  # { tmplid: Templite }
+        self.stats = dict()      # { (tmplid, linea): [ejecuciones, tiempo] }
+        self.last = dict()       # { frame: (clave, inicio) }
+        self.clock = clock
+
+    def add(self, template):
+        """Registra una plantilla, para seguir la ejecucion de su codigo"""
+        self.templates[template.tmplid] = template
+
+    def start(self):
+        """Instala el perfilador. Devuelve False si ya estaba instalado"""
+        if sys.gettrace() == self._call:
+            return False
+        sys.settrace(self._call)
+        return True
+
+    def stop(self):
+        sys.settrace(None)
+
+    def _call(self, frame, event, arg):
+        """Funcion de traza global: decide que frames se siguen"""
+        if frame.f_code.co_filename in self.templates:
+            return self._line
+        return None
+
+    def _close(self, frame, now):
+        """Acumula el tiempo de la ultima linea ejecutada en el frame"""
+        last = self.last.pop(frame, None)
+        if last is not None:
+            self.stats[last[0]][1] += now - last[1]
+
+    def _line(self, frame, event, arg):
+        """Funcion de traza local de los frames de plantilla.
+
+        Una linea de plantilla se traduce en varias lineas de python, asi
+        que solo se cuenta una ejecucion cuando cambia la linea de
+        plantilla; mientras no cambie, sigue corriendo su tiempo.
+        """
+        now = self.clock()
+        if event != "line":
+            if event == "return":
+                self._close(frame, now)
+            return self._line
+        tmplid = frame.f_code.co_filename
+        key = (tmplid, self.templates[tmplid].source_line(frame.f_lineno))
+        last = self.last.get(frame, None)
+        if last is not None and last[0] == key:
+            return self._line
+        self._close(frame, now)
+        stats = self.stats.get(key, None)
+        if stats is None:
+            stats = self.stats.setdefault(key, [0, 0.0])
+        stats[0] += 1
+        self.last[frame] = (key, now)
+        return self._line
+
+    def dump(self, fname):
+        """Vuelca el perfil, ordenado por tiempo acumulado"""
+        with open(fname, "w") as outfile:
+            outfile.write("fichero\tlinea\tejecuciones\ttiempo (ms)\n")
+            for (tmplid, lineno), (hits, elapsed) in sorted(self.stats.iteritems(), key=lambda x: -x[1][1]):
+                outfile.write("%s\t%d\t%d\t%.3f\n" % (tmplid, lineno, hits, elapsed * 1000))
+
+
+class Optimizer(ast.NodeTransformer):
+
+    """
+    Optimiza el arbol AST de una plantilla traducida, antes de compilarlo.
+
+    - Evalua las operaciones entre constantes (?4+1? => "5"), siempre
+        que el resultado sea pequeno (ver MAXLEN y MAXBITS).
+    - Une los trozos literales de un ''.join(...) y los "_out << ..."
+        consecutivos en una sola llamada.
+    - Dentro de los bucles, guarda "_out.current.append" en la variable
+        APPEND y la usa para las cadenas que seguro no estan vacias
+        (Accumulator.__lshift__ descarta las vacias).
+
+    Solo transforma el codigo que genera la propia Templite, que siempre
+    emite cadenas de texto a traves de "_out <<".
+    """
+
+    APPEND = "_append"
+    CONSTANTS = (ast.Num, ast.Str)
+
+    # Tamano maximo de las constantes calculadas: cadenas de hasta MAXLEN
+    # caracteres y enteros de hasta MAXBITS bits. Lo que sea mayor se
+    # deja para la ejecucion ("a"*10**9 no debe colgar la compilacion).
+    MAXLEN = 4096
+    MAXBITS = 128
+
+    def optimize(self, tree):
+        return ast.fix_missing_locations(self.visit(tree))
+
+    def _const(self, node, value):
+        """Sustituye un nodo por una constante, si es de tipo basico"""
+        if isinstance(value, basestring):
+            if len(value) > self.MAXLEN:
+                return node
+            return ast.copy_location(ast.Str(s=value), node)
+        if isinstance(value, (int, long)):
+            if value.bit_length() > self.MAXBITS:
+                return node
+            return ast.copy_location(ast.Num(n=value), node)
+        if isinstance(value, (float, complex)):
+            return ast.copy_location(ast.Num(n=value), node)
+        return node
+
+    def _size(self, node):
+        """Tamano de una constante: longitud si es cadena, bits si es entero"""
+        if isinstance(node, ast.Str):
+            return len(node.s)
+        if isinstance(node.n, (int, long)):
+            return node.n.bit_length()
+        return 0
+
+    def _small(self, node):
+        """Comprueba, antes de evaluarla, que la operacion no se dispara.
+
+        Las operaciones que pueden crecer mucho con operandos pequenos son
+        la potencia, la multiplicacion, el desplazamiento y el formateo de
+        cadenas (por el ancho); el resto no sobrepasan la suma de tamanos
+        de sus operandos, y _const descarta el resultado si es grande.
+        """
+        if not isinstance(node, ast.BinOp):
+            return True
+        left, right, op = node.left, node.right, node.op
+        if isinstance(op, ast.Mod):
+            return not isinstance(left, ast.Str)
+        ints = (int, long)
+        if isinstance(op, ast.Pow):
+            if isinstance(left, ast.Num) and isinstance(left.n, ints):
+                if isinstance(right, ast.Num) and isinstance(right.n, ints) and right.n > 0:
+                    # Cota inferior de los bits del resultado; si pasa el
+                    # limite por poco, _const lo descarta despues.
+                    return right.n <= self.MAXBITS and (self._size(left) - 1) * right.n < self.MAXBITS
+            return True
+        if isinstance(op, ast.LShift):
+            if isinstance(right, ast.Num) and isinstance(right.n, ints):
+                return right.n <= self.MAXBITS
+            return True
+        if isinstance(op, ast.Mult):
+            if isinstance(left, ast.Str) or isinstance(right, ast.Str):
+                seq, times = (left, right) if isinstance(left, ast.Str) else (right, left)
+                if isinstance(times, ast.Num) and isinstance(times.n, ints):
+                    return times.n <= self.MAXLEN and len(seq.s) * times.n <= self.MAXLEN
+                return True
+            return self._size(left) + self._size(right) <= self.MAXBITS
+        return True
+
+    def _fold(self, node):
+        """Evalua una expresion formada solo por constantes"""
+        if not self._small(node):
+            return node
+        try:
+            code = compile(ast.Expression(body=node), "<optimizer>", "eval")
+            return self._const(node, eval(code, {"__builtins__": {}}))
+        except Exception:
+            # La excepcion se producira (y se reportara) al ejecutar
+            return node
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.left, self.CONSTANTS) and isinstance(node.right, self.CONSTANTS):
+            return self._fold(node)
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.operand, self.CONSTANTS):
+            return self._fold(node)
+        return node
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if self._is_str(node):
+            const = node.args[0]
+            if isinstance(const, ast.Num):
+                return self._const(node, str(const.n))
+            if isinstance(const, ast.Str) and isinstance(const.s, str):
+                return const
+        if self._is_join(node):
+            return self._join(node, node.args[0].elts)
+        return node
+
+    def _is_call(self, node, nargs=1):
+        return (isinstance(node, ast.Call) and len(node.args) == nargs and
+            not (node.keywords or node.starargs or node.kwargs))
+
+    def _is_str(self, node):
+        """Comprueba si el nodo es "str(x)" """
+        return (self._is_call(node) and isinstance(node.func, ast.Name) and
+            node.func.id == "str")
+
+    def _is_join(self, node):
+        """Comprueba si el nodo es "''.join((x, y, ...))" """
+        return (self._is_call(node) and isinstance(node.func, ast.Attribute) and
+            node.func.attr == "join" and isinstance(node.func.value, ast.Str) and
+            not node.func.value.s and isinstance(node.args[0], ast.Tuple))
+
+    def _is_text(self, node):
+        """Comprueba si el nodo genera seguro una cadena de texto"""
+        return (isinstance(node, ast.Str) or self._is_str(node) or
+            (self._is_call(node) and isinstance(node.func, ast.Attribute) and
+             node.func.attr == "join" and isinstance(node.func.value, ast.Str)))
+
+    def _pure(self, node):
+        """Comprueba si evaluar el nodo no puede generar texto.
+
+        Es decir, si no llama a ninguna funcion (que podria escribir en
+        _out) salvo a "str" sobre nombres, atributos o constantes.
+        """
+        if isinstance(node, self.CONSTANTS + (ast.Name,)):
+            return True
+        if isinstance(node, ast.Attribute):
+            return self._pure(node.value)
+        if self._is_str(node):
+            return self._pure(node.args[0])
+        if self._is_join(node):
+            return all(self._pure(x) for x in node.args[0].elts)
+        return False
+
+    def _not_empty(self, node):
+        """Comprueba si el nodo genera seguro una cadena no vacia"""
+        if isinstance(node, ast.Str):
+            return bool(node.s)
+        return self._is_join(node) and any(self._not_empty(x) for x in node.args[0].elts)
+
+    def _join(self, node, elts):
+        """Construye un ''.join((elts)), uniendo los literales adyacentes"""
+        parts = list()
+        for elt in elts:
+            if self._is_join(elt):
+                items = elt.args[0].elts
+            else:
+                items = (elt,)
+            for item in items:
+                if isinstance(item, ast.Str):
+                    if not item.s:
+                        continue
+                    if parts and isinstance(parts[-1], ast.Str):
+                        parts[-1] = ast.copy_location(ast.Str(s=parts[-1].s + item.s), parts[-1])
+                        continue
+                parts.append(item)
+        if not parts:
+            return ast.copy_location(ast.Str(s=""), node)
+        if len(parts) == 1 and self._is_text(parts[0]):
+            return parts[0]
+        tup = ast.copy_location(ast.Tuple(elts=parts, ctx=ast.Load()), node)
+        func = ast.copy_location(ast.Attribute(value=ast.Str(s=""), attr="join", ctx=ast.Load()), node)
+        return ast.copy_location(ast.Call(func=func, args=[tup], keywords=[],
+            starargs=None, kwargs=None), node)
+
+    def _emitted(self, stmt):
+        """Si la sentencia es "_out << expr", devuelve expr"""
+        if (isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.BinOp) and
+                isinstance(stmt.value.op, ast.LShift) and
+                isinstance(stmt.value.left, ast.Name) and stmt.value.left.id == "_out"):
+            return stmt.value.right
+        return None
+
+    def _method(self, stmt):
+        """Si la sentencia es "_out.metodo()", devuelve el metodo"""
+        if (isinstance(stmt, ast.Expr) and self._is_call(stmt.value, 0) and
+                isinstance(stmt.value.func, ast.Attribute) and
+                isinstance(stmt.value.func.value, ast.Name) and
+                stmt.value.func.value.id == "_out"):
+            return stmt.value.func.attr
+        return None
+
+    def _body(self, stmts):
+        """Une las emisiones de texto consecutivas de un bloque.
+
+        Solo se puede unir una emision a la anterior si al evaluarla no
+        se puede escribir nada en _out (ver _pure); si no, cambiaria el
+        orden del texto.
+        """
+        result, pending = list(), list()
+        def flush():
+            if pending:
+                expr = self._join(pending[0][1], tuple(x[1] for x in pending))
+                if not (isinstance(expr, ast.Str) and not expr.s):
+                    stmt = pending[0][0]
+                    stmt.value.right = expr
+                    result.append(stmt)
+                del(pending[:])
+        for stmt in stmts:
+            expr = self._emitted(stmt)
+            if expr is not None and self._is_text(expr):
+                if not self._pure(expr):
+                    flush()
+                pending.append((stmt, expr))
+            else:
+                flush()
+                result.append(stmt)
+        flush()
+        return result or [ast.copy_location(ast.Pass(), stmts[0])]
+
+    def _loop(self, stmts):
+        """Usa APPEND en las emisiones de texto del cuerpo de un bucle.
+
+        Solo si el cuerpo empieza por "_out.refresh()" (que cambia la
+        lista actual) y no vuelve a refrescarla. Los bloques anidados
+        (push / pop) restauran la misma lista al terminar.
+        """
+        if not stmts or self._method(stmts[0]) != "refresh":
+            return stmts
+        if any(self._method(x) not in (None, "push") for x in stmts[1:]):
+            return stmts
+        result, used = [stmts[0]], False
+        for stmt in stmts[1:]:
+            expr = self._emitted(stmt)
+            if expr is not None and self._not_empty(expr):
+                func = ast.Name(id=self.APPEND, ctx=ast.Load())
+                stmt = ast.copy_location(ast.Expr(value=ast.Call(func=func,
+                    args=[expr], keywords=[], starargs=None, kwargs=None)), stmt)
+                used = True
+            result.append(stmt)
+        if not used:
+            return stmts
+        # La asignacion ha de llevar el numero de linea del refresh, o
+        # la tabla de lineas del codigo compilado seria incorrecta.
+        bind = ast.parse("%s = _out.current.append" % self.APPEND).body[0]
+        for node in ast.walk(bind):
+            ast.copy_location(node, stmts[0])
+        result.insert(1, bind)
+        return result
+
+    def generic_visit(self, node):
+        super(Optimizer, self).generic_visit(node)
+        for field in ("body", "orelse", "finalbody"):
+            stmts = getattr(node, field, None)
+            if stmts and isinstance(stmts, list) and isinstance(stmts[0], ast.stmt):
+                setattr(node, field, self._body(stmts))
+        if isinstance(node, (ast.For, ast.While)):
+            node.body = self._loop(node.body)
+        return node
+
+
 class Templite(object):
 
     """
@@ -282,6 +783,10 @@ class Templite(object):
         - Deben devolver una lista de cadenas de texto (para poder encadenar
             filtros)
 
+        - Si un filtro tiene el atributo "streaming" = True, puede recibir
+            y devolver cualquier iterable (ver FILTER). Los filtros
+            streaming consecutivos se ejecutan en una sola pasada.
+
         - Los filtros se indican en el bloque de cierre, detras de ">>"
 
     Por ejemplo:
@@ -316,6 +821,10 @@ class Templite(object):
     - translated: el codigo python de la plantilla, interpretada y
                   lista para ser compilada.
     - code:       el codigo compilado.
+    - names:      nombres globales o atributos que usa el codigo (incluidos
+                  los de funciones o expresiones anidadas).
+    - lines:      linea de la plantilla original correspondiente a cada
+                  linea del codigo traducido (la primera es lines[0]).
     """
 
     # ----------------------------------------------
@@ -402,11 +911,11 @@ class Templite(object):
             elif offset < 0:
                 # Un fin de bloque que no inicie otro, se descarta
                 # Eso si, comprobamos si tiene un filtro
-                parts = list(first.split(">>")[1:])
-                parts.append('"".join')
-                # Los filtros se aplican en orden inverso
-                filt = "".join("%s(" % x.strip() for x in reversed(parts))
-                filt += "_out.pop()" + ")" * len(parts)
+                parts = tuple(x.strip() for x in first.split(">>")[1:])
+                if parts:
+                    filt = '"".join(_filter(_out.pop(), %s))' % ", ".join(parts)
+                else:
+                    filt = '"".join(_out.pop())'
                 first, lines = None, None
             # Dedentamos las lineas que siguen a la primera.
             if lines:
@@ -499,32 +1008,47 @@ class Templite(object):
         """Procesa el template linea a linea"""
         delimiter = re.compile(r'%s(.*?)%s' % (re.escape(start), re.escape(end)), re.DOTALL)
         actions = cycle((self.do_literal, self.do_block))
+        lineno = 1
         for subpart in delimiter.split(template):
+            # Linea de la plantilla en la que empieza el contenido del
+            # trozo, ver parse_template.
+            blank = len(subpart) - len(subpart.lstrip())
+            self.lineno = lineno + subpart.count("\n", 0, blank)
+            lineno += subpart.count("\n")
             subpart = subpart.replace("\\".join(start), start)
             subpart = subpart.replace("\\".join(end), end)
             for block in actions.next()(subpart, start, end, delim, indent):
                 yield block
 
-    CURRENT = (1, tuple(sys.version_info))
+    # El codigo se guarda compilado (con marshal), asi que la version
+    # incluye el numero magico del bytecode del interprete.
+    CURRENT = (6, tuple(sys.version_info), imp.get_magic())
     @classmethod
-    def State(cls, tmplid, timestamp, template, ast):
+    def State(cls, tmplid, timestamp, template, code, lines):
         return {
             'tmplid': tmplid,
             'version': cls.CURRENT,
             'timestamp': timestamp, 
             'template': template,
-            'ast': ast,
+            'code': marshal.dumps(code),
+            'lines': lines,
         }
 
     def parse_template(self, tmplid, template, start, end, delim, indent, timestamp):
         try:
             # Pongo algo en translated por si acaso hay un error en
             # en do_template, antes de tener la plantilla traducida
-            translated, self.offset = template, 0
-            translated = "\n".join(self.do_template(template, start, end, delim, indent))
+            translated, self.offset, lines = template, 0, list()
+            def translate():
+                # Anoto la linea de la plantilla original de la que sale
+                # cada linea del codigo traducido.
+                for block in self.do_template(template, start, end, delim, indent):
+                    lines.extend((self.lineno,) * (block.count("\n") + 1))
+                    yield block
+            translated = "\n".join(translate())
             if self.offset:
                 raise SyntaxError("%i block statement(s) not terminated" % self.offset)
-            tree = ast.parse(translated, tmplid, 'exec')
+            tree = Optimizer().optimize(ast.parse(translated, tmplid, 'exec'))
 #            try:
 #                # Intento sacar el codigo del template como un fichero .py
 #                # Esto ayuda a la depuracion y demas.
@@ -535,7 +1059,8 @@ class Templite(object):
 #                    outfile.write(translated)
 #            except IOError:
 #                pass
-            return Templite.State(tmplid, timestamp, translated, tree)
+            code = compile(tree, tmplid, 'exec')
+            return Templite.State(tmplid, timestamp, translated, code, tuple(lines))
         except Exception as details:
             raise ParseError(tmplid, translated)
 
@@ -562,7 +1087,7 @@ class Templite(object):
 
     def __getstate__(self):
         """Devuelve el estado del objeto, para 'pickle'."""
-        return Templite.State(self.tmplid, self.timestamp, self.translated, self.ast)
+        return Templite.State(self.tmplid, self.timestamp, self.translated, self.code, self.lines)
 
     def __setstate__(self, state):
         """Restablece el estado del objeto desde un 'pickle'."""
@@ -571,10 +1096,17 @@ class Templite(object):
         self.tmplid = state['tmplid']
         self.timestamp = state['timestamp']
         self.translated = state['template']
-        self.ast = state['ast']
-        self.code = compile(self.ast, self.tmplid, 'exec')
+        self.lines = state['lines']
+        self.code = marshal.loads(state['code'])
+        self.names = code_names(self.code)
+
+    def source_line(self, lineno):
+        """Linea de la plantilla original de una linea del codigo traducido"""
+        if 0 < lineno <= len(self.lines):
+            return self.lines[lineno-1]
+        return lineno
 
-    def render(self, consumer, glob=None):
+    def render(self, consumer, glob=None, accumulator=None, profiler=None):
         """Ejecuta la plantilla con el consumidor y datos dados.
 
         El consumidor es una corutina. Cada vez que la plantilla genera
@@ -606,28 +1138,42 @@ class Templite(object):
         Si se produce alguna excepcion durante la ejecucion de la plantilla,
         se le traslada al consumidor envuelta en un TemplateError, y se
         aborta la ejecucion del template.
+
+        "accumulator" permite cambiar la clase del acumulador que se usa
+        (por ejemplo, por un ProfiledAccumulator). Si se da un "profiler"
+        (un LineProfiler), se perfila la ejecucion (ver embed).
         """
         if glob is None:
             glob = dict()
         glob["_consumer"] = consumer
-        glob["_out"] = Accumulator(consumer)
+        glob["_out"] = (accumulator or Accumulator)(consumer)
         glob["UNIQ"] = UNIQ
         glob["SORT"] = SORT
         glob["SKIP"] = SKIP
         glob["REVERSE"] = REVERSE
+        glob["_filter"] = FILTER
         consumer.next()
-        if self.embed(consumer, glob):
+        if self.embed(consumer, glob, profiler):
             result = "".join(glob["_out"].collect())
             if result:
                 consumer.send(result)
             consumer.close()
 
-    def embed(self, consumer, glob):
+    def embed(self, consumer, glob, profiler=None):
         """Ejecuta una plantilla embebida.
 
         Es como "render", pero considera que el consumidor y los datos
         ya estan inicializados.
+
+        Si se da un "profiler" (un LineProfiler), se anota cuantas veces
+        se ejecuta cada linea de la plantilla, y cuanto tarda.
         """
+        # Si se embebe dentro de un bucle de otra plantilla (o de ella
+        # misma), hay que restaurar la variable que usa el bucle.
+        append = glob.get(Optimizer.APPEND, None)
+        if profiler is not None:
+            profiler.add(self)
+            started = profiler.start()
         try:
             exec self.code in glob
             return True
@@ -639,6 +1185,11 @@ class Templite(object):
                 # despues de hacer el throw... me parece una tonteria, pero
                 # bueno, lo capturo.
                 pass
+        finally:
+            if append is not None:
+                glob[Optimizer.APPEND] = append
+            if profiler is not None and started:
+                profiler.stop()
 
 
 if __name__ == '__main__':
@@ -731,7 +1282,7 @@ if __name__ == '__main__':
                     loc = {}
                 consumer = Consumer(glob, loc)
                 templite = self.hookTemplite(Templite("test", t, **d))
-                templite.render(consumer(), glob, loc)
+                templite.render(consumer(), glob)
                 if result:
                     self.assertEqual(consumer.result, r)
                 if not exc:
@@ -820,12 +1371,11 @@ if __name__ == '__main__':
             self.checkTestCases(template, result, glob={'d':5})
             
         def testVariableInjection(self):
-            """Las variables normales no pasan al scope global"""
+            """Las variables normales quedan en el scope global"""
             template = "\n%(start)s x = 1 %(end)s\n%(delim)s x %(delim)s"""
             result = "1"
             data = self.checkTestCases(template, result)
-            self.failIf('x' in data.glob)
-            self.failUnless('x' in data.loc)
+            self.failUnless(data.glob['x'] == 1)
 
         def testDefInjection(self):
             """Las funciones pasan al scope global"""
@@ -848,6 +1398,75 @@ if __name__ == '__main__':
             data = self.checkTestCases(template, result)
             self.failUnless('dummy' in data.glob)
 
+        def testAccumulator(self):
+            """Se usa la clase de acumulador indicada"""
+            class Upper(Accumulator):
+                def __lshift__(self, data):
+                    return Accumulator.__lshift__(self, data.upper())
+            template = Templite("test", "{{for i in 'ab':}}\n?i?\n{{:end for}}\nc")
+            consumer = Consumer({}, {})
+            template.render(consumer(), {}, Upper)
+            self.assertEqual(consumer.result, "A\nB\nC")
+
+    class OptimizerTest(unittest.TestCase):
+
+        def optimize(self, source):
+            return Optimizer().optimize(ast.parse(source, "test", "eval")).body
+
+        def testFold(self):
+            """Se evaluan las operaciones entre constantes"""
+            self.assertEqual(self.optimize("4 + 1").n, 5)
+            self.assertEqual(self.optimize("-(2 ** 10)").n, -1024)
+            self.assertEqual(self.optimize("'ab' * 3").s, "ababab")
+
+        def testFoldLimit(self):
+            """No se evaluan las operaciones con resultados grandes"""
+            for source in ("'a' * 10**9", "2 ** 10**8", "1 << 10**9",
+                           "'%1000000000d' % 1", "'a' * 4096 + 'b'", "3 ** 120"):
+                self.failUnless(isinstance(self.optimize(source), ast.BinOp), source)
+
+        def testFoldError(self):
+            """Los errores se dejan para la ejecucion"""
+            self.failUnless(isinstance(self.optimize("1 / 0"), ast.BinOp))
+
+        def testJoin(self):
+            """Se unen los literales adyacentes de los join"""
+            node = self.optimize("''.join(('a', ''.join(('b', str(x))), 'c', 'd'))")
+            parts = node.args[0].elts
+            self.assertEqual(len(parts), 3)
+            self.assertEqual((parts[0].s, parts[2].s), ("ab", "cd"))
+            self.assertEqual(self.optimize("''.join(('a', str(1), 'b'))").s, "a1b")
+
+        def testEmissions(self):
+            """Las emisiones consecutivas se unen en una sola"""
+            tree = Optimizer().optimize(ast.parse("_out << 'a'\n_out << str(x)\n_out << 'b'"))
+            self.assertEqual(len(tree.body), 1)
+            tree = Optimizer().optimize(ast.parse("_out << 'a'\n_out << str(f())\n_out << 'b'"))
+            self.assertEqual(len(tree.body), 2)
+
+        def testEmbedAppend(self):
+            """Embeber una plantilla con bucles restaura APPEND"""
+            inner = Templite("inner", "{{for c in 'ab':}}\n?c?\n{{:end for}}\n")
+            outer = Templite("outer", "{{for i in range(2):}}\n[?i?\n{{INNER()}}\n]\n{{:end for}}\n")
+            consumer = Consumer({}, {})
+            coroutine = consumer()
+            glob = {"INNER": lambda: inner.embed(coroutine, glob)}
+            outer.render(coroutine, glob)
+            self.failUnless(consumer.exc is None)
+            self.assertEqual(consumer.result, "[0\na\nb\n]\n[1\na\nb\n]\n")
+
+    class LineProfilerTest(unittest.TestCase):
+
+        def testHits(self):
+            """Cada linea de plantilla cuenta una vez por ejecucion"""
+            template = Templite("test", "x\n{{for i in range(7):}}\n?i? ?i+1?\n{{:end for}}\nfin\n")
+            profiler = LineProfiler()
+            template.render(Consumer({}, {})(), {}, None, profiler)
+            hits = dict((k[1], v[0]) for (k, v) in profiler.stats.iteritems())
+            self.assertEqual(hits[3], 7)
+            self.assertEqual(hits[2], 8)
+            self.assertEqual(hits[5], 1)
+
     class PickledTemplateTest(TemplateTest):
 
         def hookTemplite(self, templite):
@@ -855,6 +1474,7 @@ if __name__ == '__main__':
             loaded = pickle.loads(pickle.dumps(templite))
             self.failUnless(templite.translated == loaded.translated)
             self.failUnless(templite.timestamp == loaded.timestamp)
+            self.failUnless(templite.code == loaded.code)
             return loaded
 
         def testVersionMismatch(self):
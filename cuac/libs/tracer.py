@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- vim: expandtab tabstop=4 shiftwidth=4 smarttab autoindent
+
+
+import csv
+
+from cuac.libs.meta import DataObject, DataSet
+
+
+class Tracer(object):
+
+    """
+    Registra los datos que consume cada plantilla.
+
+    Mientras esta instalado (entre "install" y "uninstall"), sustituye los
+    metodos de acceso a atributos de DataObject y DataSet por versiones
+    que anotan cada acceso. Cuando no esta instalado, las clases quedan
+    como estaban y no hay ningun coste adicional.
+
+    Cada acceso se identifica por la tupla (ruta de la tabla, PK, atributo).
+    Los accesos a un DataSet completo (recoger un atributo de todos sus
+    elementos, o filtrar por el) se anotan con PK = 0. Para ocupar poco, la
+    tupla se codifica como un unico entero:
+
+        (PK << 2 * BITS) | (codigo de tabla << BITS) | codigo de atributo
+
+    Los accesos se agrupan por nombre (normalmente, el fichero de salida
+    que se estaba generando), ver "start".
+    """
+
+    BITS = 20
+
+    def __init__(self):
+        self.metas = dict()    # { meta: codigo de tabla }
+        self.paths = list()    # [ ruta de la tabla ]
+        self.attrs = dict()    # { atributo: codigo de atributo }
+        self.traces = dict()   # { nombre: set de accesos }
+        self.current = set()
+        self._saved = None
+
+    def start(self, name):
+        """Comienza a anotar los accesos bajo el nombre dado"""
+        self.current = self.traces.setdefault(name, set())
+
+    def stop(self):
+        """Deja de anotar accesos (hasta el siguiente "start")"""
+        self.current = set()
+
+    def _tracers(self):
+        """Construye las versiones de los metodos que anotan los accesos"""
+        bits, metas, paths, attrs = Tracer.BITS, self.metas, self.paths, self.attrs
+        def record(meta, pk, attr):
+            tcode = metas.get(meta, None)
+            if tcode is None:
+                paths.append(getattr(meta, "path", ""))
+                tcode = metas.setdefault(meta, len(paths) - 1)
+            acode = attrs.get(attr, None)
+            if acode is None:
+                acode = attrs.setdefault(attr, len(attrs))
+            self.current.add((pk << (2 * bits)) | (tcode << bits) | acode)
+        getattribute, skips = object.__getattribute__, dict()
+        def trace(item, attr):
+            if attr[0] != "_":
+                # Los metodos y propiedades de la clase (HAS, SORTBY,
+                # FLIP...) no son datos, no los anoto.
+                cls = type(item)
+                skip = skips.get(cls, None)
+                if skip is None:
+                    skip = skips.setdefault(cls, frozenset(dir(cls)))
+                if attr not in skip:
+                    data = getattribute(item, "__dict__")
+                    record(data['_meta'], data.get('PK', 0), attr)
+            return getattribute(item, attr)
+        get, call = DataObject.get, DataSet.__call__
+        def trace_get(item, attr, default=None):
+            data = item.__dict__
+            record(data['_meta'], data.get('PK', 0), attr)
+            return get(item, attr, default)
+        def trace_call(dset, *crit, **shortcut):
+            meta = dset._meta
+            for attr in shortcut:
+                record(meta, 0, meta.resolve_alias(attr))
+            return call(dset, *crit, **shortcut)
+        return {
+            DataObject: {
+                "__getattribute__": trace,
+                "get": trace_get,
+            },
+            DataSet: {
+                "__getattribute__": trace,
+                "__call__": trace_call,
+            },
+        }
+
+    def install(self):
+        """Sustituye los metodos de acceso por los que anotan accesos"""
+        if self._saved is not None:
+            return
+        self._saved = dict()
+        for cls, methods in self._tracers().iteritems():
+            for name, method in methods.iteritems():
+                self._saved[(cls, name)] = cls.__dict__.get(name, None)
+                setattr(cls, name, method)
+
+    def uninstall(self):
+        """Restaura los metodos de acceso originales"""
+        if self._saved is None:
+            return
+        for (cls, name), method in self._saved.iteritems():
+            if method is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, method)
+        self._saved = None
+
+    def _decoder(self):
+        """Devuelve una funcion que decodifica los accesos anotados"""
+        bits, paths = Tracer.BITS, self.paths
+        mask = (1 << bits) - 1
+        names = dict((v, k) for (k, v) in self.attrs.iteritems())
+        def decode(code):
+            return (paths[(code >> bits) & mask], code >> (2 * bits), names[code & mask])
+        return decode
+
+    def dependencies(self):
+        """Mapa de dependencias { (tabla, PK): set de nombres }
+
+        Sirve para saber que salidas hay que regenerar cuando cambia un
+        objeto. Los accesos al DataSet completo aparecen con PK = 0.
+        """
+        decode, deps = self._decoder(), dict()
+        for name, codes in self.traces.iteritems():
+            for code in codes:
+                deps.setdefault(decode(code)[:2], set()).add(name)
+        return deps
+
+    def dump(self, fname):
+        """Vuelca los accesos en un fichero CSV.
+
+        Cada linea tiene los campos salida, tabla, PK, atributo.
+        """
+        decode = self._decoder()
+        with open(fname, "wb") as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(("salida", "tabla", "PK", "atributo"))
+            for name in sorted(self.traces):
+                for row in sorted(decode(code) for code in self.traces[name]):
+                    writer.writerow((name,) + row)
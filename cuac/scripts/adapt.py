@@ -180,9 +180,12 @@ def addblock(inname, blkno, lines, line, outfile, prefix=[0], key=[0], match=re.
 try:
 
     context = ContextMaker(options.outpath, options.ext, options.collapse)    
-    for inname in inputfiles:
-        with context.get_template_context(inname)() as outfile:
-            adapt(inname, outfile)
+    try:
+        for inname in inputfiles:
+            with context.get_template_context(inname)() as outfile:
+                adapt(inname, outfile)
+    finally:
+        context.close()
 
 except Exception as detail:
 
@@ -9,13 +9,17 @@ import logging
 import re
 import glob # pa windows, que no expande nombres
 import code
+import time
+import shlex
 
 from operator import itemgetter
 from optparse import OptionParser
+from getopt import gnu_getopt, GetoptError
 from itertools import chain
 from traceback import print_exc, print_exception, format_exception_only
 
 from cuac.libs import DataError, ParseError, TemplateError, Consumer
+from cuac.libs.server import RenderServer, DEFAULT_PORT, TOKEN_HEADER
 
 
 VERSION           = "0.0.1"
@@ -27,18 +31,150 @@ TRANSLATION_ERRNO = -6
 UNKNOWN_ERRNO     = -7
 
 USAGE = """uso: %prog [opciones] fichero [fichero...]
-Aplica los patrones (.txt) a los ficheros de datos (.csv)"""
+       %prog [opciones] compile [fichero.shelf] [patron...]
+       %prog [opciones] serve [fichero.shelf] [puerto]
+       %prog [opciones] batch [fichero.shelf] plantilla|@manifiesto [...]
+Aplica los patrones (.txt) a los ficheros de datos (.csv)
 
-def exit_with_errors(details):
-    """Sale volcando todos los mensajes de error."""
+Con "compile", compila por adelantado todos los patrones de los
+directorios indicados con -p (no del directorio actual, salvo que se
+incluya en -p) que coincidan con alguno de los patrones de nombre (por
+defecto, *.txt), los guarda en el shelf, e informa de todos los errores
+de sintaxis.
+
+Con "serve", carga los datos y atiende peticiones HTTP POST en localhost
+(por defecto, puerto 7788) a /render, con los parametros template=X y
+D=VAR=VALOR (solo valores literales), manteniendo en memoria los datos y
+patrones entre peticiones. Cada peticion debe llevar la cabecera
+X-Cuac-Token con el token que se muestra al arrancar (o el de la
+variable de entorno CUAC_TOKEN).
+
+Con "batch", carga los datos una sola vez y ejecuta con ellos todos los
+patrones indicados, informando al final de todos los errores. Cada linea
+de un manifiesto es un patron, con sus propias opciones -D y -o:
+
+    router.txt -D sitio=sitios[1] -o salida/madrid"""
+
+# Intervalo de sondeo en modo --watch, en segundos.
+WATCH_INTERVAL = 1.0
+
+def print_errors(details, debug=False):
+    """Vuelca todos los mensajes de error."""
     print >> sys.stderr, str(details) 
-    if options.debug:
+    if debug:
         if hasattr(details, 'exc_info') and details.exc_info:
             print_exception(*details.exc_info, file=sys.stderr)
         else:
             print_exc(file=sys.stderr)
+
+def exit_with_errors(details, debug=False):
+    """Sale volcando todos los mensajes de error."""
+    print_errors(details, debug)
     sys.exit(PARSE_ERRNO)    
 
+def watch(plantillator, debug=False, interval=WATCH_INTERVAL):
+    """Ejecuta la plantilla cada vez que cambian los datos o patrones.
+
+    Sondea cada "interval" segundos los ficheros de los que depende la
+    ultima ejecucion. Cuando alguno cambia, espera a que dejen de cambiar
+    (las hojas de calculo suelen guardar en varios pasos), recarga lo
+    que haya cambiado y vuelve a ejecutar. Si hay errores, los muestra y
+    sigue esperando cambios.
+    """
+    rounds = 0
+    while True:
+        try:
+            if rounds:
+                plantillator.reload()
+            plantillator.render()
+            plantillator.dump_summary()
+        except (ParseError, TemplateError, DataError) as details:
+            print_errors(details, debug)
+        except Exception as details:
+            for detail in format_exception_only(sys.exc_type, sys.exc_value):
+                sys.stderr.write(str(detail))
+            if debug:
+                print_exc(file=sys.stderr)
+        rounds += 1
+        print "Esperando cambios en los datos o patrones (Ctrl+C para salir)"
+        before = plantillator.watched()
+        after = before
+        while after == before:
+            time.sleep(interval)
+            after = plantillator.watched()
+        while True:
+            time.sleep(interval)
+            latest = plantillator.watched()
+            if latest == after:
+                break
+            after = latest
+        changed = sorted(x for x in set(before).union(after) if before.get(x) != after.get(x))
+        logging.info("Cambios en %s", ", ".join(changed))
+
+def read_manifest(fname):
+    """Lee un manifiesto de "batch".
+
+    Devuelve una lista de tuplas (patron, definiciones, outpath). Las
+    lineas en blanco y lo que sigue a un "#" se ignoran.
+    """
+    entries = list()
+    with open(fname, "r") as manifest:
+        for lineno, line in enumerate(manifest, 1):
+            words = shlex.split(line, comments=True)
+            if not words:
+                continue
+            try:
+                opts, names = gnu_getopt(words, "D:o:")
+            except GetoptError as details:
+                raise SyntaxError("%s, linea %d: %s" % (fname, lineno, details))
+            if len(names) != 1:
+                raise SyntaxError("%s, linea %d: debe haber un patron por linea" % (fname, lineno))
+            definitions = [v for (k, v) in opts if k == "-D"]
+            outpaths = [v for (k, v) in opts if k == "-o"]
+            entries.append((names[0], definitions, outpaths[-1] if outpaths else None))
+    return entries
+
+def batch(plantillator, names, jobs=None):
+    """Ejecuta todos los patrones con los datos ya cargados, y sale."""
+    entries = list()
+    for name in names:
+        if name.startswith("@"):
+            entries.extend(read_manifest(name[1:]))
+        else:
+            entries.extend((x, [], None) for x in (glob.glob(name) or [name]))
+    # Las definiciones de la linea de comandos valen para todos.
+    definitions, outpath = plantillator.definitions, plantillator.outpath
+    entries = [(name, definitions + defs, out or outpath) for (name, defs, out) in entries]
+    if not plantillator.collapse:
+        for outdir in set(out for (name, defs, out) in entries if out):
+            if not os.path.isdir(outdir):
+                os.makedirs(outdir)
+    errors = list()
+    for name, output, error in plantillator.batch(entries, jobs):
+        sys.stdout.write(output)
+        if error is not None:
+            errors.append((name, error))
+    for name, error in errors:
+        print >> sys.stderr, "*** %s\n%s" % (name, error)
+    print "Patrones: %d, con errores: %d" % (len(entries), len(errors))
+    sys.exit(PARSE_ERRNO if errors else 0)
+
+def precompile(path, dirnames, args, jobs=None):
+    """Compila las plantillas de los directorios dados, y sale."""
+    if not dirnames:
+        print >> sys.stderr, "compile: indique con -p los directorios de patrones"
+        sys.exit(OPTIONS_ERRNO)
+    plantillator = Consumer()
+    plantillator.path = path
+    if args and args[0].endswith(".shelf"):
+        plantillator.inputfiles = args[:1]
+        args = args[1:]
+    total, compiled, errors = plantillator.precompile(dirnames, args, jobs)
+    for error in errors:
+        print >> sys.stderr, error
+    print "Plantillas: %d, compiladas: %d, con errores: %d" % (total, compiled, len(errors))
+    sys.exit(PARSE_ERRNO if errors else 0)
+
 # y cargo a PLANTILLATOR!
 def main():
 
@@ -70,7 +206,45 @@ def main():
         help="Carga los datos y entra en un interprete de comandos")
     parser.add_option("-t", "--test-mode",
         action="store_true", dest="test", default=False,
-        help="Itera sobre todos los posibles valores de los 'SELECT'")
+        help="""Itera sobre todos los posibles valores de los 'SELECT', e informa
+        de los errores. Solo se conserva la salida de la primera combinacion""")
+    parser.add_option("-c", "--changed",
+        action="store_true", dest="onchange", default=False,
+        help="""Solo reemplaza los ficheros de salida cuyo contenido cambie,
+        y muestra un resumen de los ficheros modificados""")
+    parser.add_option("-i", "--incremental",
+        action="store_true", dest="incremental", default=False,
+        help="""Conserva las salidas de la ejecucion anterior cuyas plantillas,
+        tablas y definiciones no hayan cambiado. Requiere -o, y no admite -O.
+        Se asume que las plantillas no se pasan datos entre si modificando
+        los objetos, salvo a traves de APPEND.""")
+    parser.add_option("-T", "--trace", dest="trace", metavar="FICHERO",
+        help="""Guarda en FICHERO (CSV) los datos (tabla, PK y atributo) que
+        utiliza cada fichero de salida""")
+    parser.add_option("-m", "--memos",
+        action="store_true", dest="memos", default=False,
+        help="""Guarda en el shelf los resultados de CISCOSECRET (solo con salt
+        explicita) y ALUSNMPHASH, para no recalcularlos en la siguiente
+        ejecucion. Las contrasenas no
+        se guardan, solo un HMAC-SHA256 de ellas, con una clave que se
+        guarda aparte, en ~/.cuac_memo_key (o en el fichero que indique la
+        variable de entorno CUAC_MEMO_KEY); aun asi, el shelf contiene los
+        hashes resultantes, protejalo como las salidas""")
+    parser.add_option("-j", "--jobs", dest="jobs", metavar="N", type="int",
+        help="""Numero de procesos para "compile" y "batch" (por defecto,
+        uno por CPU), y para -t (por defecto, uno)""")
+    parser.add_option("-P", "--profile", dest="profile", metavar="DIR",
+        help="""Guarda en DIR, por cada fichero de salida, el volumen de texto
+        generado por cada linea de las plantillas y el tiempo de cada bloque
+        (en formato "folded", para generar flame graphs)""")
+    parser.add_option("-L", "--line-profile", dest="lineprof", metavar="FICHERO",
+        help="""Guarda en FICHERO cuantas veces se ejecuta cada linea de las
+        plantillas, y el tiempo acumulado que tarda""")
+    parser.add_option("-W", "--watch",
+        action="store_true", dest="watch", default=False,
+        help="""No termina: vuelve a ejecutar el patron cada vez que cambian
+        los ficheros CSV o los patrones. Con -o, solo regenera las salidas
+        afectadas por los cambios (como -i)""")
     parser.add_option("-x", "--ext", dest="ext", metavar=".EXT", default=".cfg",
         help="Extension del fichero resultado (por defecto, .cfg)")
     parser.add_option("-l", "--lazy",
@@ -97,10 +271,30 @@ def main():
         format='%(asctime)s %(levelname)s %(message)s',
         stream=sys.stderr)
 
+    if args and args[0] == "compile":
+        precompile(path, path[1:], args[1:], options.jobs)
+    serving = bool(args and args[0] == "serve")
+    if serving:
+        args, port = args[1:], DEFAULT_PORT
+        if args and args[-1].isdigit():
+            port = int(args.pop())
+        # El nombre de la plantilla lo da cada peticion
+        args = args[:1] + [None] if args else []
+    batching = bool(args and args[0] == "batch")
+    if batching:
+        args, patterns = args[1:], args[1:]
+        if args and args[0].endswith(".shelf"):
+            args, patterns = [args[0], None], args[1:]
+        else:
+            args = []
+        if not patterns:
+            parser.print_help(sys.stderr)
+            sys.exit(OPTIONS_ERRNO)
+
     # expando los nombres, que en windows me pueden venir con wildcards
     inputfiles = []
     for name in args:
-        globbed = glob.glob(name)
+        globbed = glob.glob(name) if name else None
         if globbed:
             inputfiles.extend(globbed)
         else:
@@ -117,6 +311,12 @@ def main():
     plantillator.lazy = options.lazy
     plantillator.test = options.test
     plantillator.warnings = options.warnings
+    plantillator.onchange = options.onchange
+    plantillator.incremental = options.incremental or options.watch
+    plantillator.trace = options.trace
+    plantillator.memos = options.memos
+    plantillator.profile = options.profile
+    plantillator.lineprof = options.lineprof
 
     try:
 
@@ -126,25 +326,46 @@ def main():
             local = dict(plantillator.loader.data)
             code.interact("Shell de pruebas", local=local)
             exit(0)
+        if batching:
+            batch(plantillator, patterns, options.jobs)
+        if serving:
+            server = RenderServer(plantillator, port, token=os.environ.get("CUAC_TOKEN"))
+            print "Atendiendo peticiones en http://127.0.0.1:%d/render" % port
+            print "Token (cabecera %s): %s" % (TOKEN_HEADER, server.token)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                exit(0)
+        if options.watch:
+            try:
+                watch(plantillator, options.debug)
+            except KeyboardInterrupt:
+                exit(0)
+        errors = None
         if not options.test:
             plantillator.render()
         else:
-            while True:
-                plantillator.render()
-                if plantillator.actor.exhausted:
-                    break
+            passes, errors = plantillator.exhaust(options.jobs or 1)
+            for choices, error in errors:
+                print >> sys.stderr, "*** %s\n%s" % (" > ".join(choices), error)
+            print "Combinaciones probadas: %d, con errores: %d" % (passes, len(errors))
+        plantillator.dump_summary()
+        plantillator.dump_trace()
+        plantillator.dump_lineprof()
+        if errors:
+            sys.exit(PARSE_ERRNO)
 
     except ParseError as details:
 
-        exit_with_errors(details)
+        exit_with_errors(details, options.debug)
 
     except TemplateError as details:
 
-        exit_with_errors(details)
+        exit_with_errors(details, options.debug)
 
     except DataError as details:
 
-        exit_with_errors(details)
+        exit_with_errors(details, options.debug)
 
     except Exception as detail:
 
@@ -2,11 +2,12 @@
 
 
 from peer_adaptor import adapt_peers
-from sumarizer import Sumarizador, Generador_ACL, SimplificaInterfaz
+from sumarizer import Sumarizador, Generador_ACL, Analizador_ACL, SimplificaInterfaz
 from builder import BuilderHelper, TagBuilder, SpecBuilder
 from graph import Graph, GraphHelper, GraphBuilder
+from topology import Topology
 from graph import LINK_SOLID, LINK_DOTTED, LINK_DASHED
 from graph import ARROW_SMALL, ARROW_LARGE, ARROW_NONE
-from yed import YedGraph
-from dot import DOT, NEATO, CIRCO, FDP, SFDP, TWOPI, DotGraph
+from yed import YedGraph, write_yed
+from dot import DOT, NEATO, CIRCO, FDP, SFDP, TWOPI, DotGraph, write_dot
 from common import TableHelper, TableBuilder, DefaultGetter
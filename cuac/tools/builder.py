@@ -121,29 +121,33 @@ class BuilderHelper(object):
                 self._propagate(descriptor.validate, self.nested)
 
         def build(self, builder, parent=None):
-            """Construye el objeto usando el builder especificado"""
-            context = getattr(builder, self.name, None)
-            if context is not None:
-                # Si el builder define una funcion especializada para el
-                # nodo, la utilizo.
-                context = context(parent, *self.arg, **self.kw)
-            else:
-                # Si no, utilizo la funcion generica "__call__"
-                context = builder(parent, self.name, self.arg, self.kw)
-            obj, append = context.next()
-            if not append:
-                append = lambda item: None
-            for item in self.nested:
-                if not hasattr(item, 'build'):
-                    append(item)
+            """Construye el objeto usando el builder especificado.
+
+            El arbol se recorre de forma iterativa, con una pila explicita,
+            asi que no hay limite de profundidad ni un frame de python por
+            cada nivel. La funcion del builder que corresponde a cada
+            nombre de nodo se busca una sola vez por construccion.
+            """
+            dispatch, ObjEntry = Dispatcher(builder), BuilderHelper.ObjEntry
+            obj, append, close = dispatch(self, parent)
+            stack, root = [(obj, append, close, iter(self.nested))], obj
+            while stack:
+                obj, append, close, pending = stack[-1]
+                for item in pending:
+                    if isinstance(item, ObjEntry):
+                        # Abro el subnodo, y sigo por sus hijos.
+                        subobj, subappend, subclose = dispatch(item, obj)
+                        stack.append((subobj, subappend, subclose, iter(item.nested)))
+                        break
+                    elif hasattr(item, 'build'):
+                        item.build(builder, obj)
+                    elif append:
+                        append(item)
                 else:
-                    item.build(builder, obj)
-            try:
-                # Termino el manejador.
-                context.next()
-            except StopIteration:
-                pass
-            return obj
+                    # Termino el manejador.
+                    stack.pop()
+                    close()
+            return root
 
         def __lshift__(self, other):
             """Agrega subobjetos al objeto"""
@@ -202,33 +206,71 @@ class BuilderHelper(object):
         return BuilderHelper.ObjEntry(name)
 
 
-def escape(item, escape=cgi.escape, unicode=unicode):
-    if item is None:
-        return "&nbsp;"
-    if not isinstance(item, unicode):
-        item = str(item).decode("utf-8")
-    return escape(item, quote=True).encode('ascii', 'xmlcharrefreplace')
+class Dispatcher(dict):
 
+    """Tabla de despacho de un builder: nombre de nodo => manejador.
 
-class IndentList(list):
+    Cada manejador recibe el ObjEntry y el objeto padre, y devuelve una
+    tupla (objeto, append, close), donde close es la funcion a llamar
+    cuando se han procesado todos los subnodos.
 
-    def __init__(self, indent="  ", values=None):
-        super(IndentList, self).__init__(values or tuple())
-        self._offset = 0
-        self._indent = indent
+    Los manejadores se crean la primera vez que aparece cada nombre, segun
+    lo que ofrezca el builder:
 
-    def append(self, item):
-        item = self._indent * self._offset + item
-        return super(IndentList, self).append(item)
+    - Una funcion con el nombre del nodo: generador (ver TagBuilder).
+    - Una funcion "_start(parent, name, arg, kw)": devuelve directamente
+        (objeto, append, close), sin crear un generador por nodo.
+    - La funcion generica "__call__": generador.
+    """
 
-    def indent(self):
-        self._offset += 1
+    def __init__(self, builder):
+        super(Dispatcher, self).__init__()
+        self.builder = builder
+
+    def __call__(self, entry, parent):
+        try:
+            handler = self[entry.name]
+        except KeyError:
+            handler = self.setdefault(entry.name, self.handler(entry.name))
+        return handler(entry, parent)
+
+    def handler(self, name):
+        """Construye el manejador de un nombre de nodo"""
+        builder = self.builder
+        special = getattr(builder, name, None)
+        if special is not None:
+            # Si el builder define una funcion especializada para el
+            # nodo, la utilizo.
+            def handler(entry, parent):
+                return self.context(special(parent, *entry.arg, **entry.kw))
+        elif hasattr(builder, "_start"):
+            # Si no, la funcion generica sin generadores...
+            def handler(entry, parent, start=builder._start):
+                return start(parent, name, entry.arg, entry.kw)
+        else:
+            # ... o la funcion generica "__call__"
+            def handler(entry, parent):
+                return self.context(builder(parent, name, entry.arg, entry.kw))
+        return handler
+
+    @staticmethod
+    def context(context):
+        """Arranca un generador, devuelve (objeto, append, close)"""
+        obj, append = context.next()
+        def close():
+            try:
+                context.next()
+            except StopIteration:
+                pass
+        return (obj, append, close)
 
-    def dedent(self):
-        self._offset -= 1
 
-    def __str__(self):
-        return "\n".join(self)
+def escape(item, escape=cgi.escape, unicode=unicode):
+    if item is None:
+        return "&nbsp;"
+    if not isinstance(item, unicode):
+        item = str(item).decode("utf-8")
+    return escape(item, quote=True).encode('ascii', 'xmlcharrefreplace')
 
 
 class TagBuilder(object):
@@ -324,33 +366,58 @@ class TagBuilder(object):
             </row>
         </body>
     </root>
+
+    Si se le pasa un fichero (outfile), el TagBuilder va escribiendo en
+    el las lineas segun se generan, en lugar de acumularlas en memoria.
     """
 
-    def __init__(self):
-        self._result = IndentList()
+    def __init__(self, outfile=None, indent="  "):
+        self._lines = list()
+        self._write = outfile.writelines if outfile else self._lines.extend
+        self._indent = indent
+        self._prefix = [""]
+        self._tags = list()
 
-    def __call__(self, parent, name, arg, kw):
+    def _line(self, line):
+        """Escribe una linea, con el sangrado que corresponda"""
+        self._write((self._prefix[len(self._tags)], line, "\n"))
+
+    def _escaped(self, literal):
+        self._line(escape(literal))
+
+    def _raw(self, literal):
+        self._line("%s" % literal)
+
+    def _start(self, parent, name, arg, kw):
+        """Abre una etiqueta. Devuelve (objeto, append, close)"""
         tag = name
         if arg:
             comments = " ".join(escape(v) for v in arg)
-            self._result.append("<!-- %s -->" % comments)
-        if kw and kw.pop("escape", True):
-            def append(literal, result=self._result):
-                result.append("%s" % escape(literal))
-        else:
-            def append(literal, result=self._result):
-                result.append("%s" % literal)
+            self._line("<!-- %s -->" % comments)
+        append = self._escaped if (kw and kw.get("escape", True)) else self._raw
         if kw:
-            attribs = ('%s="%s"' % (k, escape(v)) for k, v in kw.iteritems())
-            tag = "%s %s" % (name, " ".join(attribs))
-        self._result.append("<%s>" % tag)
-        self._result.indent()
-        yield(self._result, append)
-        self._result.dedent()
-        self._result.append("</%s>" % name)
+            attribs = ['%s="%s"' % (k, escape(v)) for k, v in kw.iteritems()
+                       if k != "escape"]
+            if attribs:
+                tag = "%s %s" % (name, " ".join(attribs))
+        self._line("<%s>" % tag)
+        self._tags.append(name)
+        if len(self._tags) >= len(self._prefix):
+            self._prefix.append(self._indent * len(self._tags))
+        return (self, append, self._end)
+
+    def _end(self):
+        """Cierra la ultima etiqueta abierta"""
+        name = self._tags.pop()
+        self._line("</%s>" % name)
+
+    def __call__(self, parent, name, arg, kw):
+        obj, append, close = self._start(parent, name, arg, kw)
+        yield (obj, append)
+        close()
 
     def __str__(self):
-        return str(self._result)
+        return "".join(self._lines)[:-1]
 
 
 class SpecBuilder(object):
@@ -83,7 +83,7 @@ class TableBuilder(object):
         'firsth':  {'class': 'first'},
     }
 
-    def __init__(self, style=None, vertical=False, repeat=False):
+    def __init__(self, style=None, vertical=False, repeat=False, outfile=None):
         """Construye una tabla a partir de los datos dados.
         
         Construye una tabla HTML. Puede recibir un diccionario con
@@ -118,6 +118,10 @@ class TableBuilder(object):
         el grupo de columnas se usa como cabecera de esas columnas.
         
         Si repeat=True, se repite la cabecera en cada grupo de filas.
+
+        La tabla se escribe segun se recorren las filas, sin construir
+        antes un arbol con todas las celdas. Si se da un fichero (outfile),
+        el HTML se va escribiendo en el en lugar de acumularse en memoria.
         """
         self._style = deepcopy(TableBuilder.STYLE)
         if vertical:
@@ -129,84 +133,115 @@ class TableBuilder(object):
         self._thcss = Toggle("eventh", "oddth", "firsth")
         self._vertical = vertical
         self._repeat = repeat
+        self._outfile = outfile
 
-    def table(self, parent, x=BuilderHelper()):
+    def table(self, parent):
         """Crea un nodo de tipo "table", top level"""
-        self._table = x.table(**self._style['table'])
         self._header = list()
         self._body   = list()
         self._htitle = None
-        builder = TagBuilder()
+        builder = TagBuilder(self._outfile)
         yield (builder, None)
+        self._out = builder
+        self._tag('table', self._style['table'])
         if not self._vertical:
             self._layout_horizontal()
         else:
             self._layout_vertical()
-        self._table.build(builder)
+        self._close()
+
+    def _tag(self, name, kw):
+        """Abre una etiqueta en la salida, devuelve la funcion append"""
+        return self._out._start(None, name, (), kw)[1]
+
+    def _close(self):
+        """Cierra la ultima etiqueta abierta en la salida"""
+        self._out._end()
+
+    def _cell(self, name, kw, value):
+        """Escribe una celda completa (th o td) con su contenido"""
+        self._content(self._tag(name, kw), value)
+        self._close()
+
+    def _content(self, append, value):
+        """Escribe el contenido de una celda.
 
-    def _layout_horizontal(self, x=BuilderHelper()):
+        Igual que BuilderHelper.ObjEntry.flatten: las listas se aplanan,
+        y los objetos de un BuilderHelper se construyen dentro de la celda.
+        """
+        if hasattr(value, 'build'):
+            value.build(self._out, self._out)
+        elif hasattr(value, '__iter__') and not hasattr(value, 'iteritems'):
+            for item in value:
+                self._content(append, item)
+        else:
+            append(value)
+
+    def _header_row(self, thtoggle):
+        style = self._style
+        self._tag('tr', style['head'])
+        for (colname, getter) in self._header:
+            self._cell('th', style[thtoggle.next()], colname)
+        self._close()
+
+    def _layout_horizontal(self):
         style, colspan = self._style, len(self._header)
-        self._table << (
-            x.thead << x.tr(**style['head']) << (
-                (x.th(**style[self._thcss.next()]) << colname)
-                for (colname, getter) in self._header
-            ),
-            x.tbody(**style['body']) << (
-                self._layout_horizontal_row(group, escape, rows, colspan)
-                for (group, escape, rows) in self._body
-            )
-        )
+        self._tag('thead', None)
+        self._header_row(self._thcss)
+        self._close()
+        self._tag('tbody', style['body'])
+        for (group, escape, rows) in self._body:
+            self._layout_horizontal_row(group, escape, rows, colspan)
+        self._close()
 
     def _layout_horizontal_row(self, group, escape, rows, colspan,
-                               tdtoggle=Toggle("eventd", "oddtd", "firstd"),
-                               x=BuilderHelper()):
+                               tdtoggle=Toggle("eventd", "oddtd", "firstd")):
         trtoggle, style = self._trcss, self._style
         if group:
             trtoggle.reset()
-            yield x.tr(**style['titletr']) << (
-                x.td(colspan=colspan, escape=escape, **style['titletd']) << group
-            )
+            self._tag('tr', style['titletr'])
+            kw = dict(colspan=colspan, escape=escape)
+            kw.update(style['titletd'])
+            self._cell('td', kw, group)
+            self._close()
         if self._repeat:
             thtoggle = self._thcss
             thtoggle.reset()
-            yield x.tr(**style['head']) << (
-                (x.th(**style[thtoggle.next()]) << colname)
-                for (colname, getter) in self._header
-            )
+            self._header_row(thtoggle)
+        getters = tuple(getter for (label, getter) in self._header)
         for row in rows:
             tdtoggle.reset()
-            firstgetter = self._header[0][1]
-            othergetter = self._header[1:]
-            yield x.tr(**style[trtoggle.next()]) << (
-                ((x.td(**style[tdtoggle.next()]) << getter(row))
-                for (label, getter) in self._header)
-            )
-
-    def _layout_vertical(self, x=BuilderHelper()):
+            self._tag('tr', style[trtoggle.next()])
+            for getter in getters:
+                self._cell('td', style[tdtoggle.next()], getter(row))
+            self._close()
+
+    def _layout_vertical(self):
         style, thtoggle = self._style, self._thcss
         if self._htitle or any(group for (group, escape, rows) in self._body):
-            self._table << x.thead << x.tr(**style['head']) << (
-                x.th(**style[thtoggle.next()]) << self._htitle,
-                ((x.th(colspan=len(rows), escape=escape, **style[thtoggle.next()]) << group)
-                 for (group, escape, rows) in self._body
-                )
-            )
-        self._table << x.tbody(**style['body']) << (
+            self._tag('thead', None)
+            self._tag('tr', style['head'])
+            self._cell('th', style[thtoggle.next()], self._htitle)
+            for (group, escape, rows) in self._body:
+                kw = dict(colspan=len(rows), escape=escape)
+                kw.update(style[thtoggle.next()])
+                self._cell('th', kw, group)
+            self._close()
+            self._close()
+        self._tag('tbody', style['body'])
+        for (colname, getter) in self._header:
             self._layout_vertical_col(colname, getter)
-            for (colname, getter) in self._header
-        )
+        self._close()
 
     def _layout_vertical_col(self, colname, getter,
-                               tdtoggle=Toggle("eventd", "oddtd"),
-                               x=BuilderHelper()):
+                               tdtoggle=Toggle("eventd", "oddtd")):
         trtoggle, style = self._trcss, self._style
         tdtoggle.reset()
-        yield x.tr(**style[trtoggle.next()]) << (
-            x.th(**style['eventh']) << colname,
-            ((x.td(**style[tdtoggle.next()]) << getter(row))
-                for row in chain(*(rows for (group, escape, rows) in self._body))
-            )
-        )
+        self._tag('tr', style[trtoggle.next()])
+        self._cell('th', style['eventh'], colname)
+        for row in chain(*(rows for (group, escape, rows) in self._body)):
+            self._cell('td', style[tdtoggle.next()], getter(row))
+        self._close()
 
     def head(self, parent, title=None):
         self._title = title
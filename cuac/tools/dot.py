@@ -8,18 +8,140 @@
 from __future__ import with_statement
 
 import subprocess
+import re
 import os
 import os.path
+import hashlib
+import multiprocessing
 
-from cuac.tools.graph import StringWrapper
+from cuac.tools.graph import StringWrapper, write_chunks
 from cuac.tools.graph import LINK_SOLID, LINK_DOTTED, LINK_DASHED, LINK_DOUBLE
 from cuac.tools.graph import ARROW_SMALL, ARROW_LARGE, ARROW_NONE
 
 
+class DotQueue(object):
+
+    """Cola de trabajos de Graphviz.
+
+    Lanza los procesos sin esperar a que terminen, hasta un maximo de
+    "maxjobs" a la vez, para que se ejecuten mientras se sigue generando
+    la plantilla. Hay que llamar a "wait" al terminar (Consumer.render
+    lo hace) para recoger los resultados.
+
+    De cada fichero generado se guarda la huella del programa, el fichero
+    de entrada y los ficheros que este referencia (iconos: atributos
+    "image" y "shapefile"). Si al volver a generarlo la huella coincide y
+    el fichero existe, no se vuelve a lanzar Graphviz. Las huellas se
+    guardan en el shelf (ver "dump" y "load").
+    """
+
+    # Ficheros referenciados desde el .dot
+    FILES_RE = re.compile(r'\b(?:image|shapefile)\s*=\s*"((?:[^"\\]|\\.)*)"')
+
+    def __init__(self, maxjobs=None):
+        self.maxjobs = maxjobs or multiprocessing.cpu_count()
+        self.running = list()   # [ (proceso, programa, entrada, salida, huella, nullfd) ]
+        self.failures = list()
+        self.digests = dict()   # { ruta absoluta de la salida: huella }
+        self.dirty = False
+
+    @staticmethod
+    def _digest(prog, source):
+        """Huella del fichero de entrada, sus iconos y el programa"""
+        digest = hashlib.md5(prog + "\0")
+        with open(source, "rb") as infile:
+            data = infile.read()
+        digest.update(data)
+        # Graphviz busca los iconos relativos al directorio actual.
+        for fname in sorted(set(DotQueue.FILES_RE.findall(data))):
+            try:
+                info = os.stat(fname)
+                digest.update("\0%s\0%r\0%d" % (fname, info.st_mtime, info.st_size))
+            except OSError:
+                digest.update("\0%s\0-" % fname)
+        return digest.hexdigest()
+
+    def submit(self, name, prog, source, outname):
+        """Encola la generacion de "outname" a partir de "source" """
+        digest, key = DotQueue._digest(name, source), os.path.abspath(outname)
+        if self.digests.get(key, None) == digest and os.path.isfile(outname):
+            return
+        # Si ya se esta generando el mismo fichero, espero a que acabe.
+        self.release(outname)
+        while len(self.running) >= self.maxjobs:
+            self._reap()
+        if self.digests.pop(key, None) is not None:
+            self.dirty = True
+        nullfd = open(os.devnull, "wb")
+        try:
+            proc = subprocess.Popen((prog, '-Tpng', "-o%s" % outname, source), stdout=nullfd, stderr=nullfd)
+        except OSError as details:
+            nullfd.close()
+            self.failures.append("*** ERROR %s FAILED: %s (%s) ***" % (name, details, source))
+            return
+        self.running.append((proc, name, source, outname, digest, nullfd))
+
+    def release(self, fname):
+        """Espera a los trabajos que leen o escriben el fichero dado.
+
+        Hay que llamarlo antes de reescribir un fichero que puede ser la
+        entrada o la salida de un trabajo en curso (ver Consumer.SAVEAS).
+        """
+        fname = os.path.abspath(fname)
+        for job in tuple(self.running):
+            if fname in (os.path.abspath(job[2]), os.path.abspath(job[3])):
+                self._finish(job)
+
+    def _reap(self):
+        """Recoge los trabajos terminados, o espera al mas antiguo"""
+        done = tuple(x for x in self.running if x[0].poll() is not None)
+        for job in (done or self.running[:1]):
+            self._finish(job)
+
+    def _finish(self, job):
+        """Espera a que termine un trabajo, y anota el resultado"""
+        proc, name, source, outname, digest, nullfd = job
+        status = proc.wait()
+        nullfd.close()
+        self.running.remove(job)
+        if status != 0:
+            self.failures.append("*** ERROR %s RETURNED %d (%s) ***" % (name, status, source))
+            return
+        self.digests[os.path.abspath(outname)] = digest
+        self.dirty = True
+
+    def wait(self):
+        """Espera a que terminen todos los trabajos.
+
+        Devuelve la lista de errores desde la ultima llamada.
+        """
+        while self.running:
+            self._finish(self.running[0])
+        failures, self.failures = self.failures, list()
+        return failures
+
+    def dump(self):
+        """Devuelve las huellas, para guardarlas en el shelf.
+
+        Devuelve None si no han cambiado desde que se cargaron.
+        """
+        if not self.dirty:
+            return None
+        self.dirty = False
+        return dict(self.digests)
+
+    def load(self, saved):
+        """Recupera las huellas guardadas con "dump" """
+        if saved:
+            self.digests.update(saved)
+
+
 class DotFilter(str):
 
     """Filtro que procesa un fichero con Graphviz"""
 
+    JOBS = DotQueue()
+
     @staticmethod
     def _find_executables(path):
         """Used by find_graphviz
@@ -66,7 +188,10 @@ class DotFilter(str):
     def _find_graphviz():
         """Locate Graphviz's executables in the system.
         
-        Tries three methods:
+        If the GRAPHVIZ_HOME environment variable is set, it only looks
+        in that directory and its "bin" subdirectory.
+
+        Otherwise, tries three methods:
         
         First: Windows Registry (Windows only)
         This requires Mark Hammond's pywin32 is installed.
@@ -84,6 +209,13 @@ class DotFilter(str):
         
         If this fails, it returns None.
         """    
+        # Method 0 (explicit override)
+        #
+        home = os.environ.get('GRAPHVIZ_HOME', None)
+        if home:
+            return (DotFilter._find_executables(os.path.join(home, "bin")) or
+                    DotFilter._find_executables(home))
+
         # Method 1 (Windows only)
         #
         if os.sys.platform == 'win32':
@@ -160,10 +292,46 @@ class DotFilter(str):
         cls.PATHS = progs
         return progs.get(prog, None)
 
+    @classmethod
+    def dump_paths(cls):
+        """Devuelve los programas encontrados, para guardarlos en el shelf.
+
+        El resultado es una tupla (GRAPHVIZ_HOME, { programa: (ruta, mtime) }),
+        o None si todavia no se han buscado o no se ha encontrado ninguno.
+        """
+        paths = getattr(cls, "PATHS", None)
+        if not paths:
+            return None
+        try:
+            progs = dict((k, (v, os.stat(v).st_mtime)) for (k, v) in paths.iteritems() if v)
+        except OSError:
+            return None
+        return (os.environ.get('GRAPHVIZ_HOME', None), progs) if progs else None
+
+    @classmethod
+    def load_paths(cls, saved):
+        """Recupera los programas guardados con "dump_paths".
+
+        Solo los usa si no se han buscado ya, si GRAPHVIZ_HOME no ha
+        cambiado y si todos los ejecutables conservan su mtime.
+        """
+        if not saved or hasattr(cls, "PATHS"):
+            return
+        home, progs = saved
+        if home != os.environ.get('GRAPHVIZ_HOME', None):
+            return
+        try:
+            if all(os.stat(path).st_mtime == mtime for (path, mtime) in progs.itervalues()):
+                cls.PATHS = dict((k, v[0]) for (k, v) in progs.iteritems())
+        except OSError:
+            pass
+
     def __call__(self, strings):
         """Crea un fichero .png utilizando el lenguaje DOT de graphviz.
     
         Es un filtro que siempre debe ser invocado despues de SAVEAS.
+        El fichero se genera en segundo plano (ver DotQueue), el filtro
+        devuelve su nombre sin esperar a que este listo.
         """
         if len(strings) != 1 or not os.path.isfile(strings[0]):
             return ("*** ERROR: NO INPUT FILE ***" ,)
@@ -171,12 +339,17 @@ class DotFilter(str):
         if prog is None:
             return ("*** ERROR: NO PROGRAM %s ***" % self,)
         outname = os.path.splitext(strings[0])[0] + ".png"
-        with open('/dev/null', 'wb') as nullfd: 
-            status = subprocess.call((prog, '-Tpng', "-o%s" % outname, strings[0]), stdout=nullfd, stderr=nullfd)
-        if status != 0:
-           return ("*** ERROR %s RETURNED %d ***" % (self, status),)
+        DotFilter.JOBS.submit(str(self), prog, strings[0], outname)
         return (outname,)
 
+    @staticmethod
+    def wait():
+        """Espera a que terminen los trabajos pendientes.
+
+        Devuelve la lista de errores.
+        """
+        return DotFilter.JOBS.wait()
+
 
 DOT   = DotFilter("dot")
 NEATO = DotFilter("neato")
@@ -206,6 +379,20 @@ def DotGraph(graph, shapedir="iconos", scale=False):
     return StringWrapper("\n".join(_graph_dot(graph, shapedir, scale)))
 
 
+def write_dot(graph, outfile, shapedir="iconos", scale=False):
+    """Escribe un grafo en formato dot, sin generarlo entero en memoria.
+
+    outfile es un objeto con metodo "write" (ver write_chunks). Por
+    ejemplo, desde una plantilla:
+
+    {{salida = OPEN("red.dot")
+      with salida as dotfile:
+          tools.write_dot(grafo, dotfile)
+    }}?tools.DOT((salida.path,))[0]?
+    """
+    return write_chunks(_graph_dot(graph, shapedir, scale), outfile)
+
+
 def _dot_escape(data):
     """Escapa un texto para meterlo en un atributo de dot"""
     # Antes usaba "repr", pero eso sustituia los caracteres no ASCII
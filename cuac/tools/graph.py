@@ -3,7 +3,12 @@
 
 from copy import copy
 from collections import namedtuple, defaultdict
-from itertools import chain, groupby, izip
+from itertools import chain, izip
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from cuac.libs.odict import OrderedDict
 
 from cuac.tools.builder import SpecBuilder, BuilderHelper
 
@@ -89,6 +94,23 @@ class StringWrapper(tuple):
         return self[0]
 
 
+def write_chunks(chunks, outfile):
+    """Escribe trozos de texto en un fichero, separados por saltos de linea.
+
+    El resultado es el mismo que el de "\n".join(chunks), pero sin
+    construir la cadena entera en memoria.
+
+    - outfile: cualquier objeto con un metodo "write". Desde una
+        plantilla, lo normal es un fichero abierto con OPEN, para que la
+        salida quede en OUTDIR y la gestionen las opciones -c e -i.
+    """
+    write, separator = outfile.write, ""
+    for chunk in chunks:
+        write(separator)
+        write(chunk)
+        separator = "\n"
+
+
 class NodeProperties(object):
 
     """Propiedades comunes de un grupo de nodos"""
@@ -260,12 +282,13 @@ class NodeGroup(tuple):
     """Lista de NodeLists pertenecientes a un mismo grupo"""
 
     def __new__(cls, nodes):
-        def key(node):
-            return node.properties
-        def group():
-            for prop, subnodes in groupby(sorted(nodes, key=key), key):
-                yield NodeList(prop, (x.descriptor for x in subnodes))
-        return super(NodeGroup, cls).__new__(cls, group())
+        # Agrupo en una sola pasada, en el orden en que aparece cada
+        # combinacion de propiedades.
+        lists = OrderedDict()
+        for node in nodes:
+            lists.setdefault(node.properties, []).append(node.descriptor)
+        return super(NodeGroup, cls).__new__(cls,
+            (NodeList(prop, descriptors) for (prop, descriptors) in lists.iteritems()))
             
     @property
     def attribs(self):
@@ -325,33 +348,67 @@ class Graph(object):
     otras...
     """
     
+    # Vistas que dependen de los nodos, y de los enlaces. Se calculan la
+    # primera vez que se piden, y se descartan cuando cambia el grafo.
+    NODE_VIEWS = ("node_properties", "node_attribs", "shapes", "IDs", "groups")
+    LINK_VIEWS = ("link_properties", "link_attribs", "links")
+
     def __init__(self):
-        self.node_dict = dict()
-        self.link_dict = dict()
+        self.node_dict = OrderedDict()
+        self.link_dict = OrderedDict()
+        # Numero de nodos y enlaces que usan cada objeto Properties, y
+        # IDs de los nodos. Se mantienen al agregar nodos y enlaces.
+        self._node_props = defaultdict(int)
+        self._link_props = defaultdict(int)
+        self._IDs = set()
+        self._views = dict()
+
+    def _view(self, name, func):
+        """Devuelve una vista cacheada, o la calcula con "func" """
+        try:
+            return self._views[name]
+        except KeyError:
+            return self._views.setdefault(name, func())
+
+    def _dirty(self, names):
+        """Descarta las vistas cacheadas"""
+        for name in names:
+            self._views.pop(name, None)
+
+    @staticmethod
+    def _count(counts, old_prop, new_prop):
+        """Actualiza el contador de uso de las properties"""
+        if old_prop is not None:
+            counts[old_prop] -= 1
+            if not counts[old_prop]:
+                del(counts[old_prop])
+        counts[new_prop] += 1
 
     @property
     def node_properties(self):
-        return frozenset(x.properties for x in self.node_dict.values())
+        return self._view("node_properties", lambda: frozenset(self._node_props))
 
     @property
     def link_properties(self):
-        return frozenset(x.properties for x in self.link_dict.values())
+        return self._view("link_properties", lambda: frozenset(self._link_props))
 
     @property
     def node_attribs(self):
-        return OrderedFSet(chain(*(x.attribs for x in self.node_properties if x.attribs)))
+        return self._view("node_attribs", lambda:
+            OrderedFSet(chain(*(x.attribs for x in self.node_properties if x.attribs))))
 
     @property
     def link_attribs(self):
-        return OrderedFSet(chain(*(x.attribs for x in self.link_properties if x.attribs)))
+        return self._view("link_attribs", lambda:
+            OrderedFSet(chain(*(x.attribs for x in self.link_properties if x.attribs))))
 
     @property
     def shapes(self):
-        return frozenset(x.shape for x in self.node_properties)
+        return self._view("shapes", lambda: frozenset(x.shape for x in self.node_properties))
 
     @property
     def IDs(self):
-        return frozenset(x.descriptor.ID for x in self.node_dict.values())
+        return self._view("IDs", lambda: frozenset(self._IDs))
 
     def add_group(self, gname, items, id_resolver, label_resolver,
                   attribs=None, **kw):
@@ -377,15 +434,20 @@ class Graph(object):
         # sino solamente uno por cada combinacion encontrada de (properties
         # antiguas, properties nuevas). Para eso, voy a crear un diccionario
         # donde ire guardando esas combinaciones.
-        new_properties = dict()
+        new_properties, counts = dict(), self._node_props
+        self._dirty(Graph.NODE_VIEWS)
         for descriptor in descriptors:
             new_node = Node(gname, properties, descriptor)
             old_node = self.node_dict.setdefault(descriptor.objID, new_node)
-            if old_node is not new_node:
+            if old_node is new_node:
+                Graph._count(counts, None, properties)
+                self._IDs.add(descriptor.ID)
+            else:
                 new_prop = new_properties.get(old_node.properties, None)
                 if not new_prop:
                     new_prop = old_node.properties.combine(properties, **kw)
                     new_properties[old_node.properties] = new_prop
+                Graph._count(counts, old_node.properties, new_prop)
                 old_node.update(new_node, new_prop)
 
     def add_links(self, items,
@@ -411,15 +473,19 @@ class Graph(object):
             src_id, src_label, src_attribs,
             dst_id, dst_label, dst_attribs,
             label_resolver)
-        new_properties = dict()
+        new_properties, counts = dict(), self._link_props
+        self._dirty(Graph.LINK_VIEWS)
         for descriptor in descriptors:
             new_link = Link(properties, descriptor)
             old_link = self.link_dict.setdefault(descriptor.objID, new_link)
-            if old_link is not new_link:
+            if old_link is new_link:
+                Graph._count(counts, None, properties)
+            else:
                 new_prop = new_properties.get(old_link.properties)
                 if not new_prop:
                     new_prop = old_link.properties.combine(properties, **kw)
                     new_properties[old_link.properties] = new_prop
+                Graph._count(counts, old_link.properties, new_prop)
                 old_link.update(new_link, new_prop)
 
     @property
@@ -429,18 +495,22 @@ class Graph(object):
         - Cada clave es un nombre de grupo
         - Cada valor es un NodeGroup con todos los NodeLists del grupo.
         """
-        def key(item):
-            return item.group
-        return dict((group, NodeGroup(items)) for (group, items)
-            in groupby(sorted(self.node_dict.values(), key=key), key))
+        def groups():
+            nodes = OrderedDict()
+            for node in self.node_dict.itervalues():
+                nodes.setdefault(node.group, []).append(node)
+            return OrderedDict((group, NodeGroup(items)) for (group, items) in nodes.iteritems())
+        return self._view("groups", groups)
 
     @property
     def links(self):
         """Devuelve una lista donde cada elemento es un LinkList"""
-        def key(item):
-            return item.properties
-        return tuple(LinkList(prop, (x.descriptor for x in items)) for (prop, items)
-            in groupby(sorted(self.link_dict.values(), key=key), key))
+        def links():
+            descriptors = OrderedDict()
+            for link in self.link_dict.itervalues():
+                descriptors.setdefault(link.properties, []).append(link.descriptor)
+            return tuple(LinkList(prop, items) for (prop, items) in descriptors.iteritems())
+        return self._view("links", links)
 
 
 x = BuilderHelper()
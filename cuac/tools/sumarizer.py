@@ -8,19 +8,30 @@
 
 
 import re
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
 from cuac.libs.IPy import IP
+from cuac.libs.ip import IPAddress
 
 
 # Conjunto de digitos al final de una cadena
 DIGIT_TAIL_RE = re.compile(r'[^\d]([\d/]+)$')
 
 
+def LISTA(texto):
+    """Divide una lista separada por comas, descartando elementos vacios"""
+    return tuple(x for x in (y.strip() for y in texto.split(",")) if x)
+
+
 class Sumarizador(tuple):
 
     """Tupla que sumariza listas de objetos agregables (IPs, rangos...)"""
 
     def __new__(cls, items):
-        return tuple.__new__(cls, Sumarizador.sumariza_todos(sorted(items)))
+        items = sorted(items)
+        if items and all(isinstance(x, IPAddress) for x in items):
+            return tuple.__new__(cls, Sumarizador.sumariza_ips(items))
+        return tuple.__new__(cls, Sumarizador.sumariza_todos(items))
 
     @staticmethod
     def sumariza(items):
@@ -57,6 +68,55 @@ class Sumarizador(tuple):
             return grouped
         return Sumarizador.sumariza_todos(grouped)
 
+    @staticmethod
+    def sumariza_ips(items):
+        """Version de sumariza_todos para listas ordenadas de IPAddress.
+
+        Hace una sola pasada, con una pila de tuplas de enteros (red,
+        bits, bitsize): cada red se apila, y mientras las dos de la cima
+        sean las dos mitades de una misma red, se sustituyen por esa red.
+        Solo se crean objetos IPAddress para las redes agregadas.
+
+        Las redes repetidas o contenidas en otra de la lista se cuentan
+        una sola vez (como la red que las contiene), y no se agregan redes
+        de distinta familia (IPv4 / IPv6). Igual que IPAddress.agg, las
+        direcciones de host (host != 0) no se agregan con nada.
+        """
+        def covers(net, bits, size, inner):
+            """Comprueba si la red (net, bits, size) contiene a inner"""
+            if net is None or inner[0] is None or size != inner[2] or bits > inner[1]:
+                return False
+            return net >> (size - bits) == inner[0] >> (size - bits)
+        # [ (red, bits, bitsize, IPAddress original o None) ]
+        stack = list()
+        for item in items:
+            if item.host:
+                stack.append((None, None, None, item))
+                continue
+            nnet, nbits, nsize = item.raw_network.int(), item.bits, item.bitsize
+            # La pila esta ordenada y sin solapes: solo la cima puede
+            # contener a la nueva red, o estar contenida en ella.
+            if stack and covers(*stack[-1][:3], inner=(nnet, nbits, nsize)):
+                continue
+            while stack and covers(nnet, nbits, nsize, stack[-1]):
+                stack.pop()
+            stack.append((nnet, nbits, nsize, item))
+            while len(stack) > 1:
+                nnet, nbits, nsize, norig = stack[-1]
+                pnet, pbits, psize, porig = stack[-2]
+                if (pnet is None or nnet is None or pbits != nbits
+                        or psize != nsize or nbits == 0
+                        or pnet ^ nnet != 1 << (nsize - nbits)):
+                    break
+                del stack[-2:]
+                stack.append((min(pnet, nnet), nbits - 1, nsize, None))
+        def result(net, bits, size, orig):
+            if orig is not None:
+                return orig
+            version = 4 if size == 32 else 6
+            return IPAddress(IP(net, ipversion=version).make_net(bits), 0)
+        return tuple(result(*x) for x in stack)
+
 
 class Generador_ACL(object):
 
@@ -65,6 +125,13 @@ class Generador_ACL(object):
     Al iterar sobre el objeto, se van generando las ACEs. El iterador
     intenta minimizar el uso de la TCAM, agregando redes contiguas y
     resumiendo puertos para reducir el numero de ACEs necesarias.
+
+    Las direcciones y listas de puertos se resuelven una sola vez por
+    generador, aunque aparezcan en muchas reglas, y las ACEs identicas a
+    otra anterior de la misma ACL (mismo protocolo, origen y destino) se
+    omiten, porque nunca llegarian a aplicarse. Tras generar la ACL,
+    "estadisticas" y "ahorro()" indican cuantas entradas de TCAM se han
+    ahorrado.
     """
 
     def __init__(self, acl, grupos_red, agg_ips=True, agg_puertos=True):
@@ -79,12 +146,25 @@ class Generador_ACL(object):
         self.grupos_red = grupos_red
         self.agg_ips = agg_ips
         self.agg_puertos = agg_puertos
+        # Cache de direcciones y puertos: { texto: (resultado, sin agregar) }
+        self._ips = dict()
+        self._puertos = dict()
+        self._reset()
+
+    def _reset(self):
+        """Reinicia las estadisticas y las ACEs ya generadas"""
+        self._vistas = set()
+        self.estadisticas = dict.fromkeys(
+            ("reglas", "originales", "generadas", "duplicadas"), 0)
 
     class Rango(object):
 
         """Rango de numeros de puerto TCP / UDP"""
 
-        def __init__(self, puerto):
+        def __init__(self, puerto, fin=None):
+            if fin is not None:
+                self.inicio, self.fin = puerto, fin
+                return
             puerto = tuple(int(x) for x in puerto.split("-"))
             if len(puerto) == 2:
                 self.inicio, self.fin = puerto
@@ -92,8 +172,9 @@ class Generador_ACL(object):
                 self.inicio = self.fin = puerto[0]
 
         def agg(self, other):
-            if self.fin >= other.inicio and self.fin <= other.fin:
-                return Rango(self.inicio, other.fin)
+            """Agrega dos rangos solapados o contiguos (other >= self)"""
+            if other.inicio <= self.fin + 1:
+                return Generador_ACL.Rango(self.inicio, max(self.fin, other.fin))
             return None
 
         def __cmp__(self, other):
@@ -145,13 +226,31 @@ class Generador_ACL(object):
         elemento es None. En otro caso, devuelve una lista de IPs
         asociadas al nombre dado.
         """
-        if isinstance(direccion, IP):
+        clave = self._clave(direccion)
+        try:
+            return self._ips[clave][0]
+        except KeyError:
+            pass
+        if isinstance(direccion, (IP, IPAddress)):
             ips = (direccion,)
         elif direccion == "*":
-            return (None,)
+            ips = (None,)
         else:
-            ips = self.grupos_red(nombre=direccion).rango
-        return ips if not self.agg_ips else Sumarizador(ips)
+            ips = tuple(self.grupos_red(nombre=direccion).rango)
+        agregadas = ips if (not self.agg_ips or direccion == "*") else Sumarizador(ips)
+        self._ips[clave] = (agregadas, len(ips))
+        return agregadas
+
+    @staticmethod
+    def _clave(direccion):
+        """Clave de una direccion en la cache.
+
+        Los objetos IP se comparan solo por la direccion de red (sin la
+        mascara), asi que no pueden ser la clave directamente.
+        """
+        if isinstance(direccion, basestring):
+            return direccion
+        return (direccion.__class__, str(direccion))
 
     def protocolos(self, puertos):
         """Distribuye la lista de puertos por protocolo"""
@@ -184,41 +283,278 @@ class Generador_ACL(object):
         rango o lista, para minimizar el numero de ACEs necesarias.
 
         Por ejemplo:
-        "80/tcp, 443/tcp, 20-21/tcp, 22/tcp, 53/udp" =>
-        => [("tcp", " range 20 22"), ("tcp", " eq 80 443"),
+        "80/tcp, 443/tcp, 20-21/tcp, 22/tcp, 23/tcp, 53/udp" =>
+        => [("tcp", " range 20 23"), ("tcp", " eq 80 443"),
             ("udp", " eq 53")]
+
+        Los rangos solapados o contiguos se funden en uno solo.
         """
-        for proto, puertos in self.protocolos(puertos).iteritems():
+        try:
+            return self._puertos[puertos][0]
+        except KeyError:
+            pass
+        agregados, originales = list(), dict()
+        for proto, lista in self.protocolos(puertos).iteritems():
             if proto in ('tcp', 'udp'):
-                puertos = (Generador_ACL.Rango(x) for x in puertos)
-                for puerto in self.agrega_puertos(puertos):
-                    yield (proto, puerto)
+                rangos = (Generador_ACL.Rango(x) for x in lista)
+                for puerto in self.agrega_puertos(rangos):
+                    agregados.append((proto, puerto))
+                originales[proto] = len(lista)
             else:
-                yield (proto, None)
+                agregados.append((proto, None))
+                originales[proto] = 1
+        agregados = tuple(agregados)
+        self._puertos[puertos] = (agregados, originales)
+        return agregados
 
     def descriptores(self, regla, attrib_ip, attrib_puerto):
         """Combina una lista de IPs y puertos en descriptores"""
-        for ip in self.ips(regla.get(attrib_ip, "*")):
-            for proto, puerto in self.puertos(regla.get(attrib_puerto, "*")):
-                yield Generador_ACL.Descriptor(ip, proto, puerto)
+        puertos = self.puertos(regla.get(attrib_puerto, "*"))
+        return tuple(Generador_ACL.Descriptor(ip, proto, puerto)
+                     for ip in self.ips(regla.get(attrib_ip, "*"))
+                     for proto, puerto in puertos)
+
+    def _originales(self, regla, attrib_ip, attrib_puerto):
+        """ACEs por protocolo de un extremo, sin agregar IPs ni puertos"""
+        direccion, puertos = regla.get(attrib_ip, "*"), regla.get(attrib_puerto, "*")
+        self.ips(direccion), self.puertos(puertos)
+        ips, puertos = self._ips[self._clave(direccion)][1], self._puertos[puertos][1]
+        return dict((proto, ips * num) for proto, num in puertos.iteritems())
+
+    def entradas(self, regla):
+        """Genera las ACEs de una regla, sin numerar ni eliminar duplicadas.
+
+        Cada ACE es una tupla (protocolo, origen, destino, texto), donde
+        origen y destino son Descriptores, y texto es la ACE sin numero
+        de orden ni accion.
+        """
+        origenes = tuple((x, str(x)) for x in
+                         self.descriptores(regla, "origen", "puerto_origen"))
+        destinos = tuple((y, str(y)) for y in
+                         self.descriptores(regla, "destino", "puerto_destino"))
+        for o, o_str in origenes:
+            for d, d_str in destinos:
+                if o.compatible(d):
+                    proto = o.protocolo or d.protocolo or "ip"
+                    yield (proto, o, d, " ".join((proto, o_str, d_str)))
 
     def regla(self, regla):
-        """Crea las ACEs de una regla"""
-        origenes = self.descriptores(regla, "origen", "puerto_origen")
-        destinos = self.descriptores(regla, "destino", "puerto_destino")
+        """Crea las ACEs de una regla.
+
+        Las ACEs que ya se han generado antes (con la misma u otra accion)
+        se omiten y se cuentan como duplicadas.
+        """
+        stats, vistas = self.estadisticas, self._vistas
+        stats["reglas"] += 1
+        orig = self._originales(regla, "origen", "puerto_origen")
+        dest = self._originales(regla, "destino", "puerto_destino")
+        stats["originales"] += sum(x * y
+            for po, x in orig.iteritems() for pd, y in dest.iteritems()
+            if po is None or pd is None or po == pd)
         orden = regla.orden
-        for o, d in ((x, y) for x in origenes for y in destinos
-                     if x.compatible(y)):
-            proto = o.protocolo or d.protocolo or "ip"
-            yield " ".join((str(orden), regla.accion, proto, str(o), str(d)))
+        for proto, o, d, ace in self.entradas(regla):
+            if ace in vistas:
+                stats["duplicadas"] += 1
+                continue
+            vistas.add(ace)
+            stats["generadas"] += 1
+            yield " ".join((str(orden), regla.accion, ace))
             orden = orden + 1
 
     def __iter__(self):
         """Genera las ACEs de una ACL"""
+        self._reset()
         for regla in self.acl:
             for ace in self.regla(regla):
                 yield ace
 
+    def ahorro(self):
+        """Resumen del ahorro de TCAM en la ultima ACL generada"""
+        stats = self.estadisticas
+        ahorro = stats["originales"] - stats["generadas"]
+        porcentaje = (100.0 * ahorro / stats["originales"]) if stats["originales"] else 0.0
+        return ("Reglas: %d, ACEs: %d (sin optimizar: %d, duplicadas: %d, "
+                "ahorro: %d, %.1f%%)" % (stats["reglas"], stats["generadas"],
+                stats["originales"], stats["duplicadas"], ahorro, porcentaje))
+
+
+# Resultado del analisis de una ACE que nunca se aplica.
+Hallazgo = namedtuple("Hallazgo", "tipo, regla, ace, previa_regla, previa_ace")
+
+
+class Analizador_ACL(tuple):
+
+    """Busca las ACEs de una ACL que nunca llegan a aplicarse.
+
+    Recibe un Generador_ACL, y es una tupla de Hallazgos, uno por cada ACE
+    cuyo trafico queda completamente cubierto por una ACE anterior:
+
+    - tipo: "sombreada" si la ACE anterior tiene otra accion (la ACE
+        no hace lo que se pretendia), o "redundante" si tiene la misma
+        accion (la ACE sobra).
+    - regla, ace: numero de orden de la regla, y texto de la ACE
+        (accion, protocolo, origen y destino).
+    - previa_regla, previa_ace: lo mismo, para una ACE anterior que la
+        cubre (de entre las que la cubren, la de rango de puertos mas
+        amplio en cada par de prefijos; no siempre la primera).
+
+    Las ACEs con listas de puertos (" eq 80 443") se consideran cubiertas
+    si cada puerto lo esta. Solo se tienen en cuenta coberturas por una
+    unica ACE anterior (o una por puerto), no por la union de varias.
+
+    Por ejemplo, desde una plantilla:
+
+    {{for h in tools.Analizador_ACL(tools.Generador_ACL(acl, grupos)):}}
+    ! {{h.tipo}}: {{h.ace}} (cubierta por {{h.previa_ace}})
+    {{:end for}}
+
+    Para no comparar cada ACE con todas las anteriores, las ACEs se
+    indexan por prefijo de origen y de destino, en un diccionario por
+    longitud de mascara (un trie comprimido): para cada ACE solo se
+    consultan los prefijos que la contienen, y dentro de ellos, los
+    rangos de puertos de destino del mismo protocolo (o "ip"), con una
+    busqueda binaria (ver _Puertos). Las ACEs cubiertas no se indexan.
+    """
+
+    PUERTOS = (0, 65535)
+
+    def __new__(cls, generador):
+        analisis = Analizador_ACL._Indice()
+        hallazgos = list()
+        for regla in generador.acl:
+            for proto, o, d, texto in generador.entradas(regla):
+                ace = " ".join((regla.accion, texto))
+                previa = analisis.agrega(regla, ace, proto, o, d)
+                if previa is not None:
+                    p_regla, p_ace = previa
+                    tipo = "redundante" if p_regla.accion == regla.accion else "sombreada"
+                    hallazgos.append(Hallazgo(tipo, regla.orden, ace,
+                                              p_regla.orden, p_ace))
+        self = tuple.__new__(cls, hallazgos)
+        self.sombreadas = tuple(x for x in self if x.tipo == "sombreada")
+        self.redundantes = tuple(x for x in self if x.tipo == "redundante")
+        return self
+
+    class _Puertos(object):
+
+        """Rangos de puertos, ordenados por puerto inicial.
+
+        Junto a cada inicio se guarda el mayor fin de los rangos que
+        empiezan en o antes de el (es una secuencia no decreciente), y
+        la ACE a la que pertenece ese fin. Asi, saber si algun rango
+        contiene a otro es una busqueda binaria y una comparacion.
+        """
+
+        def __init__(self):
+            self.inicios, self.fines, self.aces = list(), list(), list()
+
+        def cubre(self, inicio, fin):
+            """Numero de una ACE cuyo rango contiene al dado, o None"""
+            i = bisect_right(self.inicios, inicio)
+            if i and self.fines[i - 1] >= fin:
+                return self.aces[i - 1]
+            return None
+
+        def inserta(self, inicio, fin, num):
+            fines, aces = self.fines, self.aces
+            i = bisect_right(self.inicios, inicio)
+            if i and fines[i - 1] >= fin:
+                maximo, ace = fines[i - 1], aces[i - 1]
+            else:
+                maximo, ace = fin, num
+            self.inicios.insert(i, inicio)
+            fines.insert(i, maximo)
+            aces.insert(i, ace)
+            # Los maximos siguientes menores que "fin" pasan a ser "fin".
+            j = bisect_left(fines, maximo, i + 1)
+            fines[i + 1:j] = [maximo] * (j - i - 1)
+            aces[i + 1:j] = [ace] * (j - i - 1)
+
+    class _Indice(object):
+
+        """Indice de las ACEs vivas (no cubiertas) vistas hasta ahora"""
+
+        def __init__(self):
+            # { (bitsize, bits): { red: { (bitsize, bits): { red:
+            #     { proto: { (inicio_src, fin_src): _Puertos } } } } } }
+            self.origenes = dict()
+            self.aces = list()
+
+        @staticmethod
+        def prefijo(ip):
+            """Convierte una IP en tupla (bitsize, bits, red), None es "any" """
+            if ip is None:
+                return (None, 0, 0)
+            size, bits = ip.bitsize, ip.bits
+            return (size, bits, ip.raw_network.int() >> (size - bits))
+
+        @staticmethod
+        def rangos(descriptor):
+            """Lista de rangos (inicio, fin) de puertos del descriptor"""
+            puerto = descriptor.puerto
+            if descriptor.protocolo not in ('tcp', 'udp') or not puerto:
+                return (Analizador_ACL.PUERTOS,)
+            if isinstance(puerto, Generador_ACL.GrupoRangos):
+                return tuple((x.inicio, x.fin) for x in puerto)
+            return ((puerto.inicio, puerto.fin),)
+
+        @staticmethod
+        def padres(tabla, prefijo):
+            """Nodos de la tabla cuyo prefijo contiene al dado"""
+            size, bits, red = prefijo
+            for (psize, pbits), nodos in tabla.iteritems():
+                if pbits > bits or (psize is not None and psize != size):
+                    continue
+                nodo = nodos.get(red >> (bits - pbits), None)
+                if nodo is not None:
+                    yield nodo
+
+        def cubierta(self, origen, destino, proto, src, dst):
+            """Numero de una ACE que cubre a la dada, o None"""
+            primera = None
+            for nodo in self.padres(self.origenes, origen):
+                for protos in self.padres(nodo, destino):
+                    for p in set((proto, "ip")):
+                        for (s0, s1), puertos in protos.get(p, {}).iteritems():
+                            if s0 > src[0] or s1 < src[1]:
+                                continue
+                            num = puertos.cubre(*dst)
+                            if num is not None and (primera is None or num < primera):
+                                primera = num
+            return primera
+
+        def inserta(self, origen, destino, proto, src, dst, num):
+            size, bits, red = origen
+            nodo = self.origenes.setdefault((size, bits), dict()).setdefault(red, dict())
+            size, bits, red = destino
+            protos = nodo.setdefault((size, bits), dict()).setdefault(red, dict())
+            puertos = protos.setdefault(proto, dict()).get(src, None)
+            if puertos is None:
+                puertos = protos[proto].setdefault(src, Analizador_ACL._Puertos())
+            puertos.inserta(dst[0], dst[1], num)
+
+        def agrega(self, regla, ace, proto, o, d):
+            """Agrega una ACE al indice.
+
+            Si la ACE esta cubierta por otra anterior, devuelve la tupla
+            (regla, ace) de la primera que la cubre.
+            """
+            num = len(self.aces)
+            self.aces.append((regla, ace))
+            origen, destino = self.prefijo(o.ip), self.prefijo(d.ip)
+            primera = None
+            for src in self.rangos(o):
+                for dst in self.rangos(d):
+                    previa = self.cubierta(origen, destino, proto, src, dst)
+                    if previa is None:
+                        self.inserta(origen, destino, proto, src, dst, num)
+                        primera = -1
+                    elif primera is None or (primera >= 0 and previa < primera):
+                        primera = previa
+            if primera is None or primera < 0:
+                return None
+            return self.aces[primera]
+
 
 def SimplificaInterfaz(nombre_interfaz):
     """Reduce el nombre de una interfaz FastEth o GigabitEth al minimo"""
@@ -229,3 +565,105 @@ def SimplificaInterfaz(nombre_interfaz):
         nombre = inicial + indice.groups()[0]
     return nombre
     
+
+
+if __name__ == "__main__":
+
+    import unittest
+
+    class TestSumarizador(unittest.TestCase):
+
+        def ips(self, *items):
+            return [IPAddress(x) for x in items]
+
+        def testAgrega(self):
+            """Redes contiguas de la misma mascara se agregan en cascada"""
+            ips = self.ips(*("10.0.%d.0/24" % x for x in range(8)))
+            self.failUnless([str(x) for x in Sumarizador(ips)] == ["10.0.0.0 /21"])
+
+        def testNoContiguas(self):
+            """Mitades de redes distintas no se agregan"""
+            ips = self.ips("10.0.1.0/24", "10.0.2.0/24")
+            self.failUnless(Sumarizador(ips) == tuple(ips))
+
+        def testIgualAPasadas(self):
+            """Mismo resultado que sumariza_todos, con redes disjuntas"""
+            ips = sorted(self.ips("10.0.0.0/25", "10.0.0.128/25", "10.0.1.0/24",
+                                  "10.0.4.0/23", "10.0.6.0/24", "10.0.8.0/24"))
+            self.failUnless(Sumarizador.sumariza_ips(ips) ==
+                            tuple(Sumarizador.sumariza_todos(ips)))
+
+        def testDuplicadas(self):
+            """Las redes repetidas no se agregan a la red padre"""
+            ips = self.ips("10.0.0.0/24", "10.0.0.0/24")
+            self.failUnless([str(x) for x in Sumarizador(ips)] == ["10.0.0.0 /24"])
+
+        def testSolapadas(self):
+            """Las redes contenidas en otra de la lista desaparecen"""
+            for ips, expected in (
+                    (("10.0.0.0/23", "10.0.0.0/24", "10.0.1.0/24", "10.0.2.0/24"),
+                     ["10.0.0.0 /23", "10.0.2.0 /24"]),
+                    (("10.0.0.0/24", "10.0.0.0/23", "10.0.1.128/25", "10.0.2.0/23"),
+                     ["10.0.0.0 /22"]),
+                    (("10.0.0.0/25", "10.0.0.128/25", "10.0.0.0/24", "10.0.1.0/24"),
+                     ["10.0.0.0 /23"])):
+                result = Sumarizador.sumariza_ips(self.ips(*ips))
+                self.assertEqual([str(x) for x in result], expected)
+            ips = self.ips("10.0.1.0/24", "10.0.0.0/23", "10.0.0.0/24")
+            self.assertEqual([str(x) for x in Sumarizador(ips)], ["10.0.0.0 /23"])
+
+        def testHosts(self):
+            """Las direcciones de host no se agregan"""
+            ips = self.ips("10.0.0.1/24", "10.0.1.1/24")
+            self.failUnless(len(Sumarizador(ips)) == 2)
+
+        def testIPv6(self):
+            ips = self.ips("2001:db8::/64", "2001:db8:0:1::/64")
+            self.failUnless([str(x) for x in Sumarizador(ips)] == ["2001:db8:0:0:0:0:0:0 /63"])
+
+    class Regla(dict):
+
+        def __init__(self, orden, accion, **kw):
+            super(Regla, self).__init__(**kw)
+            self.orden, self.accion = orden, accion
+
+    class TestAnalizador(unittest.TestCase):
+
+        def analiza(self, *reglas):
+            return Analizador_ACL(Generador_ACL(reglas, None, agg_ips=False))
+
+        def testSombreada(self):
+            """Una ACE cubierta por otra con distinta accion"""
+            red, host = IPAddress("10.0.0.0/24"), IPAddress("10.0.0.5/32")
+            result = self.analiza(
+                Regla(10, "permit", origen=red, puerto_destino="80/tcp, 443/tcp"),
+                Regla(20, "deny", origen=host, puerto_destino="80/tcp"))
+            self.failUnless(len(result) == 1 and len(result.sombreadas) == 1)
+            self.failUnless(result[0].regla == 20 and result[0].previa_regla == 10)
+
+        def testRedundante(self):
+            """Una ACE cubierta por "ip any any" con la misma accion"""
+            result = self.analiza(
+                Regla(10, "permit"),
+                Regla(20, "permit", destino=IPAddress("10.1.0.0/16"), puerto_destino="53/udp"))
+            self.failUnless(len(result.redundantes) == 1 and not result.sombreadas)
+
+        def testPuertos(self):
+            """Los rangos de puertos solo cubren si contienen al otro"""
+            red = IPAddress("10.0.0.0/24")
+            result = self.analiza(
+                Regla(10, "permit", destino=red, puerto_destino="1-10/tcp"),
+                Regla(20, "permit", destino=red, puerto_destino="20-30/tcp"),
+                Regla(30, "deny", destino=red, puerto_destino="5-15/tcp"),
+                Regla(40, "deny", destino=red, puerto_destino="21-29/tcp"),
+                Regla(50, "deny", destino=red, puerto_destino="8-12/udp"))
+            self.failUnless([h.regla for h in result] == [40])
+
+        def testNoCubre(self):
+            """Un prefijo mas especifico no cubre a uno mas general"""
+            result = self.analiza(
+                Regla(10, "deny", origen=IPAddress("10.0.0.0/25")),
+                Regla(20, "permit", origen=IPAddress("10.0.0.0/24")))
+            self.failUnless(len(result) == 0)
+
+    unittest.main()
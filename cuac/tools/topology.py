@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+
+"""
+Indice de adyacencia sobre los enlaces (PEER) cargados de los CSV.
+
+Se construye una sola vez a partir de una lista de extremos de enlace
+(objetos con atributo PEER, normalmente interfaces), y permite
+consultar vecinos, grado, componentes conexas, caminos mas cortos y
+arboles de expansion sin recorrer los PEER en cada consulta.
+"""
+
+from array import array
+from collections import deque
+from itertools import izip
+
+
+def _default_node(item):
+    """Nodo al que pertenece un extremo de enlace: el objeto padre"""
+    return item.up
+
+
+class Topology(object):
+
+    """Topologia de la red, en formato CSR (compressed sparse row).
+
+    Cada nodo recibe un numero entero (por orden de aparicion). Los
+    vecinos del nodo "i" son targets[offsets[i]:offsets[i+1]], y para
+    cada vecino, "sides" guarda el extremo de enlace local por el que
+    se llega a el.
+
+    Por ejemplo, desde una plantilla:
+
+    {{topo = tools.Topology(sedes.switches.interfaces)}}
+    {{for vecino in topo.neighbours(switch):}}
+    ...
+    {{:end for}}
+
+    El indice es una foto de los datos en el momento de construirlo:
+    si se cambian los PEER despues, hay que volver a construirlo.
+    """
+
+    def __init__(self, items, node=None):
+        """Construye el indice.
+
+        - items: extremos de enlace (objetos con atributo PEER). Da igual
+            que aparezcan uno o los dos extremos de cada enlace.
+        - node: funcion que devuelve el nodo de un extremo de enlace. Por
+            defecto, el objeto padre (item.up).
+        """
+        node = node or _default_node
+        self.nodes, self.index = list(), dict()
+        sources, targets, ports, seen = array('l'), array('l'), list(), set()
+        for item in items:
+            peer = item.get("PEER")
+            if not peer:
+                continue
+            key = (id(item), id(peer)) if id(item) < id(peer) else (id(peer), id(item))
+            if key in seen:
+                continue
+            seen.add(key)
+            src, dst = self._intern(node(item)), self._intern(node(peer))
+            # Guardo las dos direcciones, cada una con su extremo local.
+            sources.extend((src, dst))
+            targets.extend((dst, src))
+            ports.extend((item, peer))
+        # Ordeno las aristas por nodo origen (counting sort, lineal).
+        offsets = array('l', [0]) * (len(self.nodes) + 1)
+        for src in sources:
+            offsets[src + 1] += 1
+        for i in xrange(len(self.nodes)):
+            offsets[i + 1] += offsets[i]
+        fill = array('l', offsets)
+        self.targets = array('l', [0]) * len(targets)
+        self.sides = [None] * len(ports)
+        for src, dst, port in izip(sources, targets, ports):
+            pos = fill[src]
+            fill[src] += 1
+            self.targets[pos] = dst
+            self.sides[pos] = port
+        self.offsets = offsets
+        self._labels = None
+
+    def _intern(self, obj):
+        """Devuelve el numero de nodo de un objeto, asignandolo si es nuevo"""
+        key = id(obj)
+        try:
+            return self.index[key]
+        except KeyError:
+            self.nodes.append(obj)
+            return self.index.setdefault(key, len(self.nodes) - 1)
+
+    def _id(self, obj):
+        """Numero de nodo de un objeto, o None si no tiene enlaces"""
+        return self.index.get(id(obj), None)
+
+    def _span(self, i):
+        return xrange(self.offsets[i], self.offsets[i + 1])
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, obj):
+        return id(obj) in self.index
+
+    def degree(self, obj):
+        """Numero de enlaces del nodo"""
+        i = self._id(obj)
+        return 0 if i is None else self.offsets[i + 1] - self.offsets[i]
+
+    def neighbours(self, obj):
+        """Lista de nodos vecinos (con repeticiones, si hay enlaces paralelos)"""
+        i = self._id(obj)
+        if i is None:
+            return []
+        nodes, targets = self.nodes, self.targets
+        return [nodes[targets[k]] for k in self._span(i)]
+
+    def ports(self, obj):
+        """Lista de extremos de enlace locales del nodo"""
+        i = self._id(obj)
+        return [] if i is None else [self.sides[k] for k in self._span(i)]
+
+    def _components(self):
+        """Etiqueta cada nodo con el numero de su componente conexa"""
+        if self._labels is not None:
+            return self._labels
+        labels = array('l', [-1]) * len(self.nodes)
+        targets, label = self.targets, 0
+        for start in xrange(len(self.nodes)):
+            if labels[start] >= 0:
+                continue
+            labels[start], pending = label, [start]
+            while pending:
+                i = pending.pop()
+                for k in self._span(i):
+                    j = targets[k]
+                    if labels[j] < 0:
+                        labels[j] = label
+                        pending.append(j)
+            label += 1
+        self._labels = labels
+        return labels
+
+    def components(self):
+        """Lista de componentes conexas, cada una una lista de nodos.
+
+        Las componentes y sus nodos van en orden de aparicion.
+        """
+        groups = dict()
+        for i, label in enumerate(self._components()):
+            groups.setdefault(label, []).append(self.nodes[i])
+        return [groups[x] for x in sorted(groups)]
+
+    def connected(self, src, dst):
+        """Comprueba si hay algun camino entre los dos nodos"""
+        i, j = self._id(src), self._id(dst)
+        if i is None or j is None:
+            return src is dst
+        labels = self._components()
+        return labels[i] == labels[j]
+
+    def _bfs(self, i):
+        """Recorrido en anchura desde el nodo i.
+
+        Devuelve tres arrays: distancia de cada nodo (-1 si no se alcanza),
+        nodo padre, y posicion en "targets" de la arista por la que se
+        llega desde el padre.
+        """
+        distance = array('l', [-1]) * len(self.nodes)
+        parent = array('l', [-1]) * len(self.nodes)
+        via = array('l', [-1]) * len(self.nodes)
+        distance[i], pending, targets = 0, deque((i,)), self.targets
+        while pending:
+            i = pending.popleft()
+            for k in self._span(i):
+                j = targets[k]
+                if distance[j] < 0:
+                    distance[j] = distance[i] + 1
+                    parent[j], via[j] = i, k
+                    pending.append(j)
+        return distance, parent, via
+
+    def distances(self, src):
+        """Lista de tuplas (nodo, saltos) alcanzables desde src, por distancia"""
+        i = self._id(src)
+        if i is None:
+            return [(src, 0)]
+        distance = self._bfs(i)[0]
+        reached = ((d, j) for (j, d) in enumerate(distance) if d >= 0)
+        return [(self.nodes[j], d) for (d, j) in sorted(reached)]
+
+    def path(self, src, dst):
+        """Camino mas corto (en saltos) entre dos nodos.
+
+        Devuelve la lista de nodos, incluyendo los extremos, o None si
+        no hay camino.
+        """
+        if src is dst:
+            return [src]
+        i, j = self._id(src), self._id(dst)
+        if i is None or j is None:
+            return None
+        distance, parent, via = self._bfs(i)
+        if distance[j] < 0:
+            return None
+        path = [j]
+        while j != i:
+            j = parent[j]
+            path.append(j)
+        return [self.nodes[x] for x in reversed(path)]
+
+    def tree(self, root):
+        """Arbol de expansion en anchura desde root.
+
+        Devuelve la lista de extremos de enlace (del lado del padre) de
+        las ramas del arbol. Se puede pasar tal cual a Graph.add_links.
+        """
+        i = self._id(root)
+        if i is None:
+            return []
+        distance, parent, via = self._bfs(i)
+        branches = ((distance[j], k) for (j, k) in enumerate(via) if k >= 0)
+        return [self.sides[k] for (d, k) in sorted(branches)]
+
+    def links(self, nodes=None):
+        """Lista de enlaces, un extremo por enlace.
+
+        Si se da una lista de nodos, solo devuelve los enlaces entre
+        nodos de la lista (por ejemplo, una componente conexa). El
+        resultado se puede pasar a Graph.add_links.
+        """
+        if nodes is None:
+            wanted = None
+        else:
+            wanted = frozenset(x for x in (self._id(n) for n in nodes) if x is not None)
+        result, targets = list(), self.targets
+        for i in xrange(len(self.nodes)):
+            if wanted is not None and i not in wanted:
+                continue
+            for k in self._span(i):
+                j = targets[k]
+                # Cada enlace aparece dos veces, me quedo con el extremo
+                # del nodo de menor numero (o con uno, si es un bucle).
+                if j < i or (wanted is not None and j not in wanted):
+                    continue
+                port = self.sides[k]
+                if j == i and id(port) > id(port.PEER):
+                    continue
+                result.append(port)
+        return result
+
+
+if __name__ == "__main__":
+
+    import unittest
+
+    class Nodo(object):
+
+        def __init__(self, name):
+            self.name = name
+
+        def __repr__(self):
+            return self.name
+
+    class Puerto(object):
+
+        def __init__(self, up):
+            self.up, self.PEER = up, None
+
+        def get(self, attr):
+            return getattr(self, attr)
+
+    def enlaza(a, b):
+        """Crea un enlace entre dos nodos, devuelve los dos extremos"""
+        x, y = Puerto(a), Puerto(b)
+        x.PEER, y.PEER = y, x
+        return (x, y)
+
+    class TestTopology(unittest.TestCase):
+
+        def setUp(self):
+            # a - b - c - d, con un enlace doble a - b, y e - f aparte.
+            self.a, self.b, self.c, self.d, self.e, self.f, self.g = (
+                Nodo(x) for x in "abcdefg")
+            self.ports = list()
+            for src, dst in ((self.a, self.b), (self.a, self.b), (self.b, self.c),
+                             (self.c, self.d), (self.e, self.f)):
+                self.ports.extend(enlaza(src, dst))
+            self.ports.append(Puerto(self.g))
+            self.topo = Topology(self.ports)
+
+        def testNodes(self):
+            """Los nodos sin enlaces no estan en la topologia"""
+            self.assertEqual(len(self.topo), 6)
+            self.failUnless(self.a in self.topo)
+            self.failIf(self.g in self.topo)
+
+        def testDegree(self):
+            """Cada enlace cuenta una vez, aunque esten los dos extremos"""
+            self.assertEqual(self.topo.degree(self.a), 2)
+            self.assertEqual(self.topo.degree(self.b), 3)
+            self.assertEqual(self.topo.degree(self.g), 0)
+            self.assertEqual(Topology(self.ports[::2]).degree(self.b), 3)
+
+        def testNeighbours(self):
+            """Vecinos y extremos locales de cada nodo"""
+            self.assertEqual(sorted(self.topo.neighbours(self.b)),
+                             sorted((self.a, self.a, self.c)))
+            for port in self.topo.ports(self.c):
+                self.failUnless(port.up is self.c)
+            self.assertEqual(self.topo.neighbours(self.g), [])
+
+        def testComponents(self):
+            """Componentes conexas"""
+            self.assertEqual(self.topo.components(),
+                [[self.a, self.b, self.c, self.d], [self.e, self.f]])
+            self.failUnless(self.topo.connected(self.a, self.d))
+            self.failIf(self.topo.connected(self.a, self.e))
+            self.failUnless(self.topo.connected(self.g, self.g))
+
+        def testPath(self):
+            """Camino mas corto"""
+            self.assertEqual(self.topo.path(self.a, self.d),
+                             [self.a, self.b, self.c, self.d])
+            self.assertEqual(self.topo.path(self.a, self.a), [self.a])
+            self.failUnless(self.topo.path(self.a, self.f) is None)
+            self.failUnless(self.topo.path(self.a, self.g) is None)
+
+        def testDistances(self):
+            """Distancias desde un nodo"""
+            self.assertEqual(self.topo.distances(self.b),
+                [(self.b, 0), (self.a, 1), (self.c, 1), (self.d, 2)])
+
+        def testTree(self):
+            """El arbol de expansion tiene una rama por nodo alcanzable"""
+            tree = self.topo.tree(self.a)
+            self.assertEqual(len(tree), 3)
+            self.assertEqual(set(x.PEER.up for x in tree), set((self.b, self.c, self.d)))
+
+        def testLinks(self):
+            """Un extremo por enlace, opcionalmente dentro de unos nodos"""
+            self.assertEqual(len(self.topo.links()), 5)
+            self.assertEqual(len(self.topo.links([self.a, self.b])), 2)
+            self.assertEqual(len(self.topo.links([self.a, self.c])), 0)
+
+        def testLoop(self):
+            """Un enlace de un nodo consigo mismo aparece una vez"""
+            topo = Topology(enlaza(self.a, self.a))
+            self.assertEqual(topo.degree(self.a), 2)
+            self.assertEqual(len(topo.links()), 1)
+
+    unittest.main()
@@ -10,7 +10,7 @@ from xml.sax.saxutils import escape
 from collections import namedtuple
 
 from cuac.libs.pathfinder import FileSource
-from cuac.tools.graph import StringWrapper
+from cuac.tools.graph import StringWrapper, write_chunks
 from cuac.tools.graph import LINK_SOLID, LINK_DOTTED, LINK_DASHED, LINK_DOUBLE
 from cuac.tools.graph import ARROW_SMALL, ARROW_LARGE, ARROW_NONE
 
@@ -46,6 +46,57 @@ def read_svg(path):
         pass
 
 
+# Cache de iconos, compartida por todos los graficos del proceso:
+# { ruta absoluta: (mtime, ShapeFile) }. Se puede guardar en el shelf
+# (ver dump_shapes y load_shapes).
+SHAPES = dict()
+
+# Contenido de los iconos ya escapado para el GraphML: { data: escapado }
+RESOURCES = dict()
+
+
+def load_shape(path):
+    """Lee un icono SVG, usando la cache si el fichero no ha cambiado.
+
+    Devuelve un ShapeFile, o None si el fichero no se puede leer.
+    """
+    path = os.path.abspath(path)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    cached = SHAPES.get(path, None)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    shape = read_svg(path)
+    if shape is not None:
+        SHAPES[path] = (mtime, shape)
+    return shape
+
+
+def dump_shapes():
+    """Devuelve la cache de iconos, para guardarla en el shelf"""
+    # Como tuplas normales, el namedtuple no se puede serializar.
+    return dict((path, (mtime, tuple(shape))) for (path, (mtime, shape)) in SHAPES.iteritems())
+
+
+def load_shapes(saved):
+    """Recupera la cache de iconos guardada con "dump_shapes".
+
+    Las entradas se validan con el mtime del fichero cuando se usan.
+    """
+    for path, (mtime, shape) in (saved or dict()).iteritems():
+        SHAPES.setdefault(path, (mtime, ShapeFile(*shape)))
+
+
+def _resource(shape):
+    """Devuelve el contenido del icono escapado, para el GraphML"""
+    try:
+        return RESOURCES[shape.data]
+    except KeyError:
+        return RESOURCES.setdefault(shape.data, escape(shape.data))
+
+
 STYLES = {
     LINK_SOLID: "line",
     LINK_DOTTED: "dotted",
@@ -66,13 +117,27 @@ def YedGraph(graph, shapedir="iconos", plain=False):
     - shapedir: Directorio donde encontrar los iconos (en .svg)
     - plain: si es True, se ignora la clasificacion en grupos.
     """
+    return StringWrapper("\n".join(_yed_chunks(graph, shapedir, plain)))
+
+
+def write_yed(graph, outfile, shapedir="iconos", plain=False):
+    """Escribe un grafo en formato yEd, sin generarlo entero en memoria.
+
+    outfile es un objeto con metodo "write", normalmente un fichero
+    abierto con OPEN desde la plantilla (ver write_chunks y write_dot).
+    """
+    return write_chunks(_yed_chunks(graph, shapedir, plain), outfile)
+
+
+def _yed_chunks(graph, shapedir, plain):
+    """Genera el texto en formato yEd, trozo a trozo"""
     # Primero, asegurarnos de que las shapes son legibles
     gshapes   = tuple(x for x in graph.shapes if x)
-    sfiles    = dict((s, read_svg(os.path.join(shapedir, s)+".svg")) for s in gshapes)
+    sfiles    = dict((s, load_shape(os.path.join(shapedir, s)+".svg")) for s in gshapes)
     if any(x is None for x in sfiles.values()):
-        return "\n".join(["Could not read the following shapes:",
-                 "\n".join(key for (key, value) in sfiles.iteritems() if value is None)
-              ])
+        yield "Could not read the following shapes:"
+        yield "\n".join(key for (key, value) in sfiles.iteritems() if value is None)
+        return
     # Primero, encontrar cuantos IDs de recurso tengo que reservar
     # yEd es muy curioso... cuando cargue este grafico me va a mostrar
     # los atributos alreves, pero cuando lo guarde les vuelve a dar
@@ -82,10 +147,15 @@ def YedGraph(graph, shapedir="iconos", plain=False):
     reserved  = len(nattribs) + reserved
     lattribs  = dict((v, i+reserved) for (i, v) in enumerate(graph.link_attribs))
     reserved  = len(lattribs) + reserved
-    shapes    = dict((v, i+reserved) for (i, v) in enumerate(gshapes))
+    # Los iconos con el mismo contenido comparten recurso.
+    shapes, refids = dict(), dict()
+    for shape in gshapes:
+        data = sfiles[shape].data
+        shapes[shape] = refids.setdefault(data, len(refids) + reserved)
     resources = Resources(nattribs, lattribs, shapes)
     # Y devolvemos el resultado
-    return StringWrapper("\n".join(_graph_yed(graph, resources, sfiles, plain)))
+    for chunk in _graph_yed(graph, resources, sfiles, plain):
+        yield chunk
 
 
 def _graph_yed(graph, resources, sfiles, plain):
@@ -183,10 +253,14 @@ def _graph_yed(graph, resources, sfiles, plain):
         '<data key="d0">',
         '  <y:Resources>',
     ))
-    for shape, key in resources.shapes.iteritems():
+    done = set()
+    for shape, key in sorted(resources.shapes.iteritems(), key=lambda x: x[1]):
+        if key in done:
+            continue
+        done.add(key)
         yield "".join((
             '    <y:Resource id="%d" type="java.lang.String">' % key,
-            escape(sfiles[shape].data),
+            _resource(sfiles[shape]),
             '    </y:Resource>',
         ))
     yield "\n".join((